@@ -143,6 +143,13 @@ class MainApplication(tk.Tk):
                                               width=12)
         process_button.pack(side='left', padx=5, pady=5)
 
+        preview_button = create_styled_button(audience_frame, "Preview", self.audience_tab.start_preview,
+                                              width=12)
+        preview_button.pack(side='left', padx=5, pady=5)
+
+        write_button = create_styled_button(audience_frame, "Write", self.audience_tab.write_preview, width=12)
+        write_button.pack(side='left', padx=5, pady=5)
+
         view_result_button = create_styled_button(audience_frame, "View", self.audience_tab.view_result,
                                                   width=12)
         view_result_button.pack(side='left', padx=5, pady=5)
@@ -1,10 +1,19 @@
 import logging
 import os
 
+import numpy as np
 import pandas as pd
+from scipy import sparse
 import sys
 import json
+import hashlib
+import importlib.util
+import re
+import shutil
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
+from openpyxl import Workbook
+from openpyxl.cell import WriteOnlyCell
 from openpyxl.reader.excel import load_workbook
 from openpyxl.styles import PatternFill, Font, Side, Border
 from openpyxl.utils import get_column_letter
@@ -14,73 +23,599 @@ from openpyxl.utils.dataframe import dataframe_to_rows
 
 logging.basicConfig(level=logging.INFO)
 
-def load_excel(file_path):
-    return pd.read_excel(file_path)
+EOP_VOLUME_PATTERN = re.compile(r'^sum_eop_vol_(\d{4})$')
+KEY_COLUMNS = ['PERIOD_YEAR', 'PERIOD_MONTH', 'PROD_NUM', 'BUS_CHANL_NUM']
+VIEWING_MINUTES_PATTERN = re.compile(r'^\w+_VIEWING_MINUTES$')
+ID_COLUMNS = ['PROD_NUM', 'BUS_CHANL_NUM']
 
 
-def calculate_forecast(df, references_month, references_year, target_start_year, target_end_year, specifics_enabled,
-                       prod_nums, bus_chanl_nums):
-    print("Filtering reference data based on provided month and year...")
-    reference_data_current_year = df[
-        (df['PERIOD_YEAR'] == references_year) &
-        (df['PERIOD_MONTH'] <= references_month)
-        ]
-    reference_data_previous_year = df[
-        (df['PERIOD_YEAR'] == (references_year - 1)) &
-        (df['PERIOD_MONTH'] > references_month)
-        ]
-    reference_data = pd.concat([reference_data_previous_year, reference_data_current_year])
-    print(f"Reference data after initial filter: {len(reference_data)} rows")
+def metric_columns(columns, metrics=None):
+    """The metric columns a forecast scales or models: metrics when given, else the *_VIEWING_MINUTES columns of
+    columns in their order."""
+    if metrics:
+        return list(metrics)
+    return [column for column in columns if VIEWING_MINUTES_PATTERN.match(str(column))]
+
+
+PERIOD_DTYPES = {'PERIOD_YEAR': 'int16', 'PERIOD_MONTH': 'int8'}
+
+
+def apply_audience_schema(df, float32_minutes=False, metrics=None):
+    """Compact dtypes for audience data: categorical IDs, int16 years, int8 months and, optionally, float32 minutes.
+
+    Period columns with missing or non-integer values keep the dtype they were loaded with.
+    """
+    columns = {}
+    for col in ID_COLUMNS:
+        if col in df.columns:
+            columns[col] = df[col].astype('category')
+    for col, dtype in PERIOD_DTYPES.items():
+        if col in df.columns and df[col].dtype.kind in 'iuf':
+            values = df[col].to_numpy()
+            if not np.isnan(values.astype('float64')).any() and (values == np.round(values)).all():
+                columns[col] = df[col].astype(dtype)
+    if float32_minutes:
+        for col in metric_columns(df.columns, metrics):
+            if col in df.columns:
+                columns[col] = df[col].astype('float32')
+    return df.assign(**columns)
+
+
+class IdEncoding:
+    """Stable integer codes for the distinct IDs of a column, with their string labels, built once per loaded file.
+
+    A code is the ID's position in the column's categories, and -1 means a missing value. Row subsets of a
+    categorical column keep these codes, so a selection of ID strings is matched against the labels once and then
+    applied to rows as a boolean lookup by code.
+    """
+
+    def __init__(self, column):
+        if not isinstance(column.dtype, pd.CategoricalDtype):
+            column = column.astype('category')
+        self.dtype = column.dtype
+        self.labels = pd.Index(column.cat.categories.astype(str))
+
+    def codes(self, column):
+        if column.dtype == self.dtype:
+            return column.cat.codes.to_numpy()
+        return pd.Categorical(column, dtype=self.dtype).codes
+
+    def lookup(self, selected):
+        """Boolean table indexed by code, with a trailing False that code -1 (missing) lands on."""
+        return np.append(self.labels.isin([str(value) for value in selected]), False)
+
+    def mask(self, column, selected):
+        return self.lookup(selected)[self.codes(column)]
+
+    def present_labels(self, column):
+        codes = np.unique(self.codes(column))
+        return self.labels[codes[codes >= 0]]
+
+
+def id_encodings(df):
+    return {col: IdEncoding(df[col]) for col in ID_COLUMNS}
+
+
+def load_excel(file_path, float32_minutes=False):
+    return apply_audience_schema(pd.read_excel(file_path), float32_minutes)
+
+
+AUDIENCE_FILE_EXTENSIONS = ('.xlsx', '.xls', '.csv')
+
+
+def audience_files(path):
+    """The extracts behind an audience source: a single file, a list of files, or the extracts of a folder.
+
+    Later files win on shared keys. A list keeps the order it was given in; a folder's extracts are taken in name
+    order, so monthly extracts named by period (e.g. audience_2024_05.xlsx) win in period order.
+    """
+    if isinstance(path, (list, tuple)):
+        return list(path)
+    if os.path.isdir(path):
+        return sorted(os.path.join(path, name) for name in os.listdir(path)
+                      if name.lower().endswith(AUDIENCE_FILE_EXTENSIONS) and not name.startswith('~$'))
+    return [path]
+
+
+def workbook_template(path):
+    """The last Excel extract of an audience source, used as the base of the output workbook; None when the source
+    has only CSV extracts."""
+    workbooks = [file for file in audience_files(path) if not file.lower().endswith('.csv')]
+    return workbooks[-1] if workbooks else None
+
+
+def read_audience_file(file_path, cache_dir=None):
+    """Reads one extract, from its columnar copy in cache_dir when the same contents were parsed before."""
+    read = pd.read_csv if file_path.lower().endswith('.csv') else pd.read_excel
+    if cache_dir is None:
+        return read(file_path)
+    digest = file_digest(file_path)
+    for path in (os.path.join(cache_dir, digest + '.parquet'), os.path.join(cache_dir, digest + '.pkl')):
+        if os.path.exists(path):
+            try:
+                data = read_columnar(path)
+                os.utime(path)
+                return data
+            except Exception as e:
+                logging.warning(f"Could not read the cached copy of {file_path}: {e}")
+    print(f"Parsing {file_path}...")
+    data = read(file_path)
+    os.makedirs(cache_dir, exist_ok=True)
+    write_columnar(data, columnar_path(cache_dir, digest))
+    return data
+
+
+def evict_least_recently_used(cache_dir, max_bytes, description):
+    """Removes the entries of cache_dir (files, or directories of files) with the oldest modification times until
+    the rest holds at most max_bytes."""
+    entries = []
+    for name in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, name)
+        if os.path.isdir(path):
+            size = sum(os.path.getsize(os.path.join(path, file)) for file in os.listdir(path))
+        else:
+            size = os.path.getsize(path)
+        entries.append((os.path.getmtime(path), size, path))
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        if os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+        else:
+            os.remove(path)
+        total -= size
+        logging.info(f"Evicted {description} {path}")
+
+
+def evict_source_cache(cache_dir, max_bytes=None):
+    """Removes the least recently used parsed extracts until cache_dir holds at most max_bytes
+    (FORECAST_CACHE_MAX_BYTES by default), so copies of replaced or re-exported extracts do not pile up."""
+    if not cache_dir or not os.path.isdir(cache_dir):
+        return
+    evict_least_recently_used(cache_dir, FORECAST_CACHE_MAX_BYTES if max_bytes is None else max_bytes,
+                              "parsed extract")
+
+
+def combine_audience_files(frames):
+    """Stacks extracts in the order they win in; a key found in several files keeps only the rows of the last one.
+
+    Duplicates within a single file are left in place for the duplicate key checks.
+    """
+    if len(frames) == 1:
+        return frames[0]
+    combined = pd.concat(frames, ignore_index=True)
+    rank = pd.Series(np.repeat(np.arange(len(frames)), [len(frame) for frame in frames]))
+    latest = rank.groupby([combined[col] for col in KEY_COLUMNS], sort=False, dropna=False).transform('max')
+    keep = (rank == latest).to_numpy()
+    if not keep.all():
+        logging.info(f"{int((~keep).sum())} rows replaced by later extracts")
+    return combined[keep].reset_index(drop=True)
+
+
+def load_audience(path, float32_minutes=False, cache_dir=None, workers=None, metrics=None):
+    """Loads an audience source (see audience_files), reading several extracts in parallel threads."""
+    files = audience_files(path)
+    if not files:
+        raise ValueError(f"No audience extracts found in {path}")
+    if len(files) == 1:
+        data = read_audience_file(files[0], cache_dir)
+    else:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            frames = list(executor.map(lambda file: read_audience_file(file, cache_dir), files))
+        data = combine_audience_files(frames)
+    evict_source_cache(cache_dir)
+    return apply_audience_schema(data, float32_minutes, metrics)
+
+
+def period_key(years, months):
+    """Integer period key (year * 12 + month): consecutive months map to consecutive integers."""
+    if hasattr(years, 'astype'):
+        # Widen first: compact int16 years would overflow once multiplied.
+        years, months = years.astype('int64'), months.astype('int64')
+    return years * 12 + months
+
+
+class AudienceSource:
+    """Audience data kept sorted on its period key, so any range of periods is a binary-search slice.
+
+    metrics names the metric columns every forecast of the source scales or models (see metric_columns).
+    """
+
+    def __init__(self, df, metrics=None):
+        self.df = df
+        self.metrics = metric_columns(df.columns, metrics)
+        keys = period_key(df['PERIOD_YEAR'].to_numpy(dtype='int64'), df['PERIOD_MONTH'].to_numpy(dtype='int64'))
+        self.order = np.argsort(keys, kind='stable')
+        self.sorted_keys = keys[self.order]
+        self._id_encodings = None
+
+    @property
+    def id_encodings(self):
+        """IdEncoding of PROD_NUM and BUS_CHANL_NUM, built on first use."""
+        if self._id_encodings is None:
+            self._id_encodings = id_encodings(self.df)
+        return self._id_encodings
+
+    def period_positions(self, first_key, last_key):
+        """Positions of the rows whose period key lies in [first_key, last_key], grouped by period."""
+        start = np.searchsorted(self.sorted_keys, first_key, side='left')
+        stop = np.searchsorted(self.sorted_keys, last_key, side='right')
+        return self.order[start:stop]
+
+    def reference_window(self, references_month, references_year):
+        """The 12 months up to the reference month: previous-year rows first, each year in file order."""
+        reference_key = period_key(references_year, references_month)
+        positions = self.period_positions(reference_key - 11, reference_key)
+        years = self.df['PERIOD_YEAR'].to_numpy()[positions]
+        return self.df.iloc[positions[np.lexsort((positions, years))]]
+
+
+def as_audience_source(data, metrics=None):
+    return data if isinstance(data, AudienceSource) else AudienceSource(data, metrics)
+
+
+def period_slices(df):
+    """Maps each period key present in df to the positions of its rows, in row order."""
+    keys = period_key(df['PERIOD_YEAR'].to_numpy(dtype='int64'), df['PERIOD_MONTH'].to_numpy(dtype='int64'))
+    order = np.argsort(keys, kind='stable')
+    unique_keys, starts = np.unique(keys[order], return_index=True)
+    return dict(zip(unique_keys.tolist(), np.split(order, starts[1:])))
+
+
+def eop_volume_columns(columns):
+    """{year: column} for every sum_eop_vol_YYYY column, in year order."""
+    volume_columns = {}
+    for column in columns:
+        match = EOP_VOLUME_PATTERN.match(str(column))
+        if match:
+            volume_columns[int(match.group(1))] = column
+    return dict(sorted(volume_columns.items()))
+
+
+def eop_volume_sums(reference_data):
+    """sum_eop_vol_YYYY totals per (PERIOD_KEY, PROD_NUM, BUS_CHANL_NUM). Totals of row chunks add up to the whole."""
+    keys = [period_key(reference_data['PERIOD_YEAR'], reference_data['PERIOD_MONTH']).rename('PERIOD_KEY'),
+            reference_data['PROD_NUM'], reference_data['BUS_CHANL_NUM']]
+    volume_columns = eop_volume_columns(reference_data.columns)
+    return reference_data.groupby(keys, observed=True)[list(volume_columns.values())].sum().astype('float64')
 
+
+def compute_growth_factors(reference_data, target_start_year, target_end_year):
+    return growth_factors_from_volumes(eop_volume_sums(reference_data), target_start_year, target_end_year)
+
+
+def growth_factors_from_volumes(volumes, target_start_year, target_end_year):
+    """Growth factors per (PERIOD_KEY, PROD_NUM, BUS_CHANL_NUM), one column per target year, from eop_volume_sums.
+
+    Every pair of consecutive sum_eop_vol_YYYY columns gives a one-year step, sum_eop_vol_Y / sum_eop_vol_(Y-1).
+    A row's factor for a target year compounds the steps after its reference PERIOD_YEAR, up to the target year.
+    A step is skipped when its denominator is zero or missing. The factor is NaN, meaning the row is carried over
+    unscaled, when no step in its range applies.
+    """
+    volume_columns = eop_volume_columns(volumes.columns)
+    if len(volume_columns) < 2:
+        logging.warning("Fewer than two sum_eop_vol_YYYY columns, forecast rows are not scaled.")
+
+    volume_years = np.array(list(volume_columns), dtype='int64')
+    step_years = np.intersect1d(volume_years[1:], volume_years[:-1] + 1)
+    previous = volumes.to_numpy()[:, np.searchsorted(volume_years, step_years - 1)]
+    current = volumes.to_numpy()[:, np.searchsorted(volume_years, step_years)]
+    valid_steps = ~np.isnan(previous) & (previous != 0) & ~np.isnan(current)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        steps = np.where(valid_steps, current / previous, 1.0)
+
+    target_years = list(range(target_start_year, target_end_year + 1))
+    base_years = (volumes.index.get_level_values('PERIOD_KEY').to_numpy() - 1) // 12
+    after_base = step_years[None, :] > base_years[:, None]
+    factors = np.empty((len(volumes), len(target_years)))
+    for column, target_year in enumerate(target_years):
+        in_range = after_base & (step_years[None, :] <= target_year)
+        factors[:, column] = np.where(in_range, steps, 1.0).prod(axis=1)
+        factors[~(in_range & valid_steps).any(axis=1), column] = np.nan
+    return pd.DataFrame(factors, index=volumes.index, columns=target_years)
+
+
+def align_growth_factors(growth_factors, reference_data):
+    """Joins the growth-factor table onto reference_data: one row of factors per reference row, one column per
+    target year."""
+    keys = pd.MultiIndex.from_arrays([
+        period_key(reference_data['PERIOD_YEAR'], reference_data['PERIOD_MONTH']),
+        reference_data['PROD_NUM'], reference_data['BUS_CHANL_NUM']])
+    return growth_factors.reindex(keys).to_numpy(dtype='float64')
+
+
+def filter_specifics(reference_data, specifics_enabled, prod_nums, bus_chanl_nums, encodings=None):
+    """Keeps the rows whose IDs, as strings, are selected; an empty selection keeps every row.
+
+    encodings are the IdEncoding of the loaded file (AudienceSource.id_encodings) and are built from reference_data
+    when not given.
+    """
     if specifics_enabled:
         print("Filtering reference data based on specifics...")
         print(f"Selected PROD_NUMs: {prod_nums}")
         print(f"Selected BUS_CHANL_NUMs: {bus_chanl_nums}")
-        unique_prod_nums = reference_data['PROD_NUM'].astype(str).unique()
-        unique_bus_chanl_nums = reference_data['BUS_CHANL_NUM'].astype(str).unique()
-        print(f"Unique PROD_NUMs in reference data: {unique_prod_nums}")
-        print(f"Unique BUS_CHANL_NUMs in reference data: {unique_bus_chanl_nums}")
-
-        if not prod_nums:
-            prod_nums = unique_prod_nums.tolist()
-        if not bus_chanl_nums:
-            bus_chanl_nums = unique_bus_chanl_nums.tolist()
-
-        reference_data = reference_data[
-            (reference_data['PROD_NUM'].astype(str).isin(prod_nums)) &
-            (reference_data['BUS_CHANL_NUM'].astype(str).isin(bus_chanl_nums))
-            ]
+        encodings = encodings or id_encodings(reference_data)
+        print(f"Unique PROD_NUMs in reference data: "
+              f"{encodings['PROD_NUM'].present_labels(reference_data['PROD_NUM']).tolist()}")
+        print(f"Unique BUS_CHANL_NUMs in reference data: "
+              f"{encodings['BUS_CHANL_NUM'].present_labels(reference_data['BUS_CHANL_NUM']).tolist()}")
+        reference_data = reference_data[specifics_mask(reference_data, prod_nums, bus_chanl_nums, encodings)]
         print(f"Reference data after specifics filter: {len(reference_data)} rows")
+    return reference_data
+
+
+def specifics_mask(reference_data, prod_nums, bus_chanl_nums, encodings):
+    keep = np.ones(len(reference_data), dtype=bool)
+    for col, selected in (('PROD_NUM', prod_nums), ('BUS_CHANL_NUM', bus_chanl_nums)):
+        if selected:
+            keep &= encodings[col].mask(reference_data[col], selected)
+    return keep
+
 
+DUPLICATE_POLICIES = {'error', 'sum', 'first', 'last'}
+DUPLICATE_REPORT_ROWS = 20
+DUPLICATE_REPORT_FILENAME = "duplicate_keys.csv"
+RUN_STATUS_FILENAME = "run_status.json"
+
+
+def find_duplicate_keys(data, row_numbers=True):
+    """One row per duplicated key with its COUNT and, with row_numbers, the Excel row numbers of its first
+    DUPLICATE_REPORT_ROWS rows.
+
+    Row numbers come from the index, so they only point into the file for a single-extract source: the index of
+    combined extracts runs over all of them.
+    """
+    duplicated = data.duplicated(subset=KEY_COLUMNS, keep=False).to_numpy()
+    duplicates = data.loc[duplicated, KEY_COLUMNS]
+    grouped = duplicates.groupby(KEY_COLUMNS, sort=False, dropna=False, observed=True)
+    report = grouped.size().rename('COUNT').to_frame()
+    if not row_numbers:
+        return report.reset_index()
+    # Excel rows: the header is row 1 and load_excel keeps the default 0-based index.
+    duplicates = duplicates.assign(EXCEL_ROWS=(duplicates.index.to_numpy() + 2).astype(str))
+    listed = duplicates[grouped.cumcount().to_numpy() < DUPLICATE_REPORT_ROWS]
+    report['EXCEL_ROWS'] = listed.groupby(KEY_COLUMNS, sort=False, dropna=False, observed=True)['EXCEL_ROWS'].agg(";".join)
+    return report.reset_index()
+
+
+def has_duplicate_keys(reference_data):
     print("Checking for duplicates...")
-    duplicates = reference_data[
-        reference_data.duplicated(subset=['PERIOD_YEAR', 'PERIOD_MONTH', 'PROD_NUM', 'BUS_CHANL_NUM'], keep=False)
-    ]
+    duplicates = find_duplicate_keys(reference_data)
     if not duplicates.empty:
-        print("Duplicates found, generating error message...")
-        duplicate_info = duplicates[['PERIOD_YEAR', 'PERIOD_MONTH', 'PROD_NUM', 'BUS_CHANL_NUM']].drop_duplicates()
-        duplicate_details = "\n".join([
-            f"Year: {row.PERIOD_YEAR}, Month: {row.PERIOD_MONTH}, Prod Num: {row.PROD_NUM}, Bus Chanl Num: {row.BUS_CHANL_NUM}"
-            for idx, row in duplicate_info.iterrows()
-        ])
-
-        duplicate_rows = duplicates.index.tolist()
-        duplicate_rows_info = "\n".join([f"Row Number: {row_num}" for row_num in duplicate_rows])
-
-        error_message = f"Duplicate rows found in the reference file based on 'PERIOD_YEAR', 'PERIOD_MONTH', 'PROD_NUM', 'BUS_CHANL_NUM':\n{duplicate_details}\n\nDuplicate Rows:\n{duplicate_rows_info}"
-        # show_message("Error", error_message, type='error')
+        print(f"Duplicates found: {len(duplicates)} keys over {duplicates['COUNT'].sum()} rows")
+        return True
+    return False
+
+
+def collapse_duplicate_keys(data, policy, metrics=None):
+    """Keeps one row per key: the first or last one in file order, or ('sum') the first one with summed minutes."""
+    if policy in ('first', 'last'):
+        return data.drop_duplicates(subset=KEY_COLUMNS, keep=policy)
+    metrics = metric_columns(data.columns, metrics)
+    aggregations = {col: 'sum' if col in metrics else 'first'
+                    for col in data.columns if col not in KEY_COLUMNS}
+    collapsed = data.groupby(KEY_COLUMNS, sort=False, dropna=False, observed=True).agg(aggregations).reset_index()
+    return collapsed[data.columns]
+
+
+def write_duplicate_report(duplicates, output_dir):
+    report_path = os.path.join(output_dir, DUPLICATE_REPORT_FILENAME)
+    duplicates.to_csv(report_path, index=False)
+    logging.info(f"Duplicate key report saved to {report_path}")
+    return report_path
+
+
+def remove_run_reports(output_dir):
+    """Removes the run status and reports a previous run left in output_dir, so none of them passes for current."""
+    gap_report_prefix = os.path.splitext(GAP_REPORT_FILENAME)[0]
+    for name in os.listdir(output_dir):
+        # Gap reports come one per reference window for scenarios: reference_gaps_MM_YYYY.csv.
+        if name in (RUN_STATUS_FILENAME, DUPLICATE_REPORT_FILENAME) or \
+                (name.startswith(gap_report_prefix) and name.endswith('.csv')):
+            os.remove(os.path.join(output_dir, name))
+
+
+def write_run_status(output_dir, status, message, **details):
+    """Leaves a small JSON status in output_dir for the caller to display once the script has exited."""
+    with open(os.path.join(output_dir, RUN_STATUS_FILENAME), 'w') as f:
+        json.dump({'status': status, 'message': message, **details}, f, indent=2, default=str)
+
+
+def prepare_source(file_path, parameters, output_dir, duplicates_policy='error', float32_minutes=False,
+                   source_cache_dir=None, gap_fill=None, metrics=None):
+    """Loads the audience file(s), resolves duplicate keys and checks the reference window for missing months.
+
+    parameters is one forecast_parameters() dict or a list of them (scenarios), whose reference windows are all
+    checked. With the 'error' policy only the requested reference windows are checked, and None is returned when
+    they have duplicates. The other policies collapse every duplicated key in the file. Either way a CSV report of
+    the duplicates and a run status are written to output_dir. Missing months are reported, and filled when gap_fill
+    names a strategy, by fill_reference_gaps: one report per reference window when there are several.
+    """
+    data = load_audience(file_path, float32_minutes, source_cache_dir, metrics=metrics)
+    missing = [col for col in metric_columns(data.columns, metrics) if col not in data.columns]
+    if missing:
+        logging.error(f"Metric columns missing from {file_path}: {missing}")
+        return None
+    source = AudienceSource(data, metrics)
+    parameter_sets = parameters if isinstance(parameters, list) else [parameters]
+    if duplicates_policy == 'error':
+        checked = pd.concat([filter_specifics(source.reference_window(checked_parameters['references_month'],
+                                                                      checked_parameters['references_year']),
+                                              checked_parameters['specifics_enabled'],
+                                              checked_parameters['prod_nums'], checked_parameters['bus_chanl_nums'],
+                                              source.id_encodings)
+                             for checked_parameters in parameter_sets])
+        # Scenarios sharing a reference window select the same rows; check each row once.
+        checked = checked[~checked.index.duplicated()]
+    else:
+        checked = data
+    resolved = resolve_duplicate_keys(data, checked, output_dir, duplicates_policy, source.metrics,
+                                      row_numbers=len(audience_files(file_path)) == 1)
+    if resolved is None:
+        return None
+    if resolved is not data:
+        source = AudienceSource(resolved, source.metrics)
+    windows = list(dict.fromkeys((checked_parameters['references_month'], checked_parameters['references_year'])
+                                 for checked_parameters in parameter_sets))
+    for references_month, references_year in windows:
+        report_filename = GAP_REPORT_FILENAME if len(windows) == 1 else \
+            f"{os.path.splitext(GAP_REPORT_FILENAME)[0]}_{references_month:02d}_{references_year}.csv"
+        source = fill_reference_gaps(source, references_month, references_year, output_dir, gap_fill,
+                                     report_filename)
+    return source
+
+
+def resolve_duplicate_keys(data, checked, output_dir, duplicates_policy='error', metrics=None, row_numbers=True):
+    """Returns data unchanged when checked has no duplicate keys, None when they stop the run ('error'), or data
+    collapsed with the policy. Reports and run statuses are written as described in prepare_source; row_numbers is
+    passed on to find_duplicate_keys."""
+    duplicates = find_duplicate_keys(checked, row_numbers)
+    if duplicates.empty:
+        return data
+
+    report_path = write_duplicate_report(duplicates, output_dir)
+    summary = f"{len(duplicates)} duplicate (PERIOD_YEAR, PERIOD_MONTH, PROD_NUM, BUS_CHANL_NUM) keys over " \
+              f"{duplicates['COUNT'].sum()} rows"
+    if duplicates_policy == 'error':
+        message = f"{summary} in the reference data. See {report_path}"
+        logging.error(message)
+        write_run_status(output_dir, 'duplicates', message, report=report_path, duplicate_keys=len(duplicates))
+        return None
+
+    message = f"{summary} collapsed with the '{duplicates_policy}' policy. See {report_path}"
+    logging.warning(message)
+    write_run_status(output_dir, 'collapsed', message, report=report_path, duplicate_keys=len(duplicates),
+                     policy=duplicates_policy)
+    return collapse_duplicate_keys(data, duplicates_policy, metrics)
+
+
+GAP_FILL_STRATEGIES = {'zero', 'carry_forward', 'seasonal_mean'}
+GAP_REPORT_FILENAME = "reference_gaps.csv"
+
+
+def reference_coverage(window, references_month, references_year):
+    """Series x 12-month grid of the reference window: each cell holds the position of the series' row for that
+    month in window, or -1 when the month is missing.
+
+    The series are the (PROD_NUM, BUS_CHANL_NUM) pairs present in window. Returns (series, period keys, positions).
+    """
+    reference_key = period_key(references_year, references_month)
+    keys = np.arange(reference_key - 11, reference_key + 1)
+    rows = pd.Series(np.arange(len(window)), index=pd.MultiIndex.from_arrays(
+        [window['PROD_NUM'], window['BUS_CHANL_NUM'],
+         period_key(window['PERIOD_YEAR'], window['PERIOD_MONTH']).rename('PERIOD_KEY')]))
+    rows = rows[~rows.index.duplicated()]
+    series = rows.index.droplevel('PERIOD_KEY').unique()
+    grid = pd.MultiIndex.from_arrays([series.get_level_values(0).repeat(len(keys)),
+                                      series.get_level_values(1).repeat(len(keys)),
+                                      np.tile(keys, len(series))])
+    positions = rows.reindex(grid, fill_value=-1).to_numpy().reshape(len(series), len(keys))
+    return series, keys, positions
+
+
+def gap_fill_values(strategy, history, window, series, keys, positions, nearest, metrics):
+    """Metric values of every grid cell of reference_coverage under a fill strategy (series x months x metrics).
+
+    'zero' fills with zeros, 'carry_forward' with the series' nearest earlier month (its first month for leading
+    gaps) and 'seasonal_mean' with the series' mean for that calendar month over history, or the mean of its
+    months in the window when history has none.
+    """
+    block = np.nan_to_num(window[metrics].to_numpy(dtype='float64'))
+    if strategy == 'zero':
+        return np.zeros(positions.shape + (len(metrics),))
+    if strategy == 'carry_forward':
+        return block[positions[np.arange(len(series))[:, None], nearest]]
+
+    present = positions >= 0
+    values = np.where(present[:, :, None], block[positions], 0.0)
+    window_mean = values.sum(axis=1) / present.sum(axis=1)[:, None]
+    months = (keys - 1) % 12 + 1
+    seasonal = history.groupby([history['PROD_NUM'], history['BUS_CHANL_NUM'], history['PERIOD_MONTH']],
+                               observed=True)[metrics].mean()
+    grid = pd.MultiIndex.from_arrays([series.get_level_values(0).repeat(len(keys)),
+                                      series.get_level_values(1).repeat(len(keys)),
+                                      np.tile(months, len(series))])
+    seasonal = seasonal.reindex(grid).to_numpy(dtype='float64').reshape(positions.shape + (len(metrics),))
+    return np.where(np.isnan(seasonal), window_mean[:, None, :], seasonal)
+
+
+def fill_reference_gaps(source, references_month, references_year, output_dir, strategy=None,
+                        report_filename=GAP_REPORT_FILENAME):
+    """Reports the series missing months in the reference window and, with a strategy, adds rows for them.
+
+    The report lists one row per missing (series, month) in report_filename. A filled row copies the other
+    columns of the series' nearest earlier row (its first row for leading gaps) and takes its minutes from
+    gap_fill_values. Returns the source, with the filled rows appended when there are any.
+    """
+    window = source.reference_window(references_month, references_year)
+    series, keys, positions = reference_coverage(window, references_month, references_year)
+    present = positions >= 0
+    if present.all():
+        return source
+
+    gap_series, gap_months = np.nonzero(~present)
+    report = pd.DataFrame({'PROD_NUM': series.get_level_values(0)[gap_series],
+                           'BUS_CHANL_NUM': series.get_level_values(1)[gap_series],
+                           'PERIOD_YEAR': (keys[gap_months] - 1) // 12,
+                           'PERIOD_MONTH': (keys[gap_months] - 1) % 12 + 1,
+                           'MONTHS_PRESENT': present.sum(axis=1)[gap_series]})
+    report_path = os.path.join(output_dir, report_filename)
+    report.to_csv(report_path, index=False)
+    logging.warning(f"{len(report)} missing reference months over {len(np.unique(gap_series))} series. "
+                    f"See {report_path}")
+    if strategy is None:
+        return source
+
+    # Nearest present month at or before each cell, falling back to the first present month for leading gaps.
+    months = np.arange(len(keys))
+    nearest = np.maximum.accumulate(np.where(present, months, -1), axis=1)
+    nearest = np.where(nearest < 0, np.argmax(present, axis=1)[:, None], nearest)
+
+    history = source.df.iloc[source.period_positions(0, keys[-1])]
+    metrics = source.metrics
+    values = gap_fill_values(strategy, history, window, series, keys, positions, nearest, metrics)
+    filled = window.iloc[positions[gap_series, nearest[gap_series, gap_months]]].copy()
+    filled['PERIOD_YEAR'] = report['PERIOD_YEAR'].to_numpy().astype(window['PERIOD_YEAR'].dtype)
+    filled['PERIOD_MONTH'] = report['PERIOD_MONTH'].to_numpy().astype(window['PERIOD_MONTH'].dtype)
+    filled[metrics] = values[gap_series, gap_months]
+    filled = filled.astype({col: dtype for col, dtype in window[metrics].dtypes.items() if dtype.kind == 'f'})
+    print(f"Filled {len(filled)} missing reference months with the '{strategy}' strategy")
+    return AudienceSource(pd.concat([source.df, filled], ignore_index=True), metrics)
+
+
+def select_reference_data(source, references_month, references_year, specifics_enabled, prod_nums, bus_chanl_nums):
+    """Returns the 12-month reference window, or None when it contains duplicate keys."""
+    print("Filtering reference data based on provided month and year...")
+    source = as_audience_source(source)
+    reference_data = source.reference_window(references_month, references_year)
+    print(f"Reference data after initial filter: {len(reference_data)} rows")
+
+    reference_data = filter_specifics(reference_data, specifics_enabled, prod_nums, bus_chanl_nums,
+                                      source.id_encodings if specifics_enabled else None)
+    if has_duplicate_keys(reference_data):
+        return None
+    return reference_data
+
+
+def calculate_forecast(source, references_month, references_year, target_start_year, target_end_year, specifics_enabled,
+                       prod_nums, bus_chanl_nums):
+    source = as_audience_source(source)
+    reference_data = select_reference_data(source, references_month, references_year, specifics_enabled, prod_nums,
+                                           bus_chanl_nums)
+    if reference_data is None:
         return pd.DataFrame(), pd.DataFrame()
 
-    print("Calculating reference eop volumes...")
-    eop_2024 = reference_data.groupby(['PERIOD_YEAR', 'PERIOD_MONTH', 'PROD_NUM', 'BUS_CHANL_NUM'])[
-        'sum_eop_vol_2024'].sum()
-    eop_2025 = reference_data.groupby(['PERIOD_YEAR', 'PERIOD_MONTH', 'PROD_NUM', 'BUS_CHANL_NUM'])[
-        'sum_eop_vol_2025'].sum()
+    print("Calculating reference growth factors...")
+    growth_factors = compute_growth_factors(reference_data, target_start_year, target_end_year)
 
+    reference_slices = period_slices(reference_data)
+    metrics = source.metrics
     forecast_data = []
 
     print("Starting forecast calculation...")
     for year in range(target_start_year, target_end_year + 1):
+        year_growth_factors = growth_factors[year]
         for month in range(1, 13):
             if month <= references_month:
                 ref_period_year = references_year
@@ -89,23 +624,19 @@ def calculate_forecast(df, references_month, references_year, target_start_year,
                 ref_period_year = references_year - 1
                 ref_period_month = month
 
-            ref_data = reference_data[
-                (reference_data['PERIOD_YEAR'] == ref_period_year) &
-                (reference_data['PERIOD_MONTH'] == ref_period_month)
-                ]
+            ref_period_key = period_key(ref_period_year, ref_period_month)
+            ref_data = reference_data.iloc[reference_slices.get(ref_period_key, [])]
 
             for index, row in ref_data.iterrows():
                 prod_num = row['PROD_NUM']
                 bus_chanl_num = row['BUS_CHANL_NUM']
 
-                eop_2024_val = eop_2024.get((ref_period_year, ref_period_month, prod_num, bus_chanl_num), float('nan'))
-                eop_2025_val = eop_2025.get((ref_period_year, ref_period_month, prod_num, bus_chanl_num), float('nan'))
+                growth_factor = year_growth_factors.get((ref_period_key, prod_num, bus_chanl_num), float('nan'))
 
                 forecast_row = row.copy()
-                if not pd.isna(eop_2024_val) and eop_2024_val != 0 and not pd.isna(eop_2025_val):
-                    for col in ['LIVE_TV_VIEWING_MINUTES', 'PVR_VIEWING_MINUTES', 'CUTV_VIEWING_MINUTES',
-                                'OTT_VIEWING_MINUTES', 'VOD_VIEWING_MINUTES']:
-                        forecasted_viewing = row[col] * eop_2025_val / eop_2024_val
+                if not pd.isna(growth_factor):
+                    for col in metrics:
+                        forecasted_viewing = row[col] * growth_factor
                         forecast_row[col] = forecasted_viewing
                 forecast_row['PERIOD_YEAR'] = year
                 forecast_row['PERIOD_MONTH'] = month
@@ -115,6 +646,665 @@ def calculate_forecast(df, references_month, references_year, target_start_year,
     return pd.DataFrame(forecast_data), reference_data
 
 
+def forecast_reference_rows(reference_data, factors, target_start_year, target_end_year, predictions=None,
+                            metrics=None):
+    """Builds the forecast rows of reference_data for every target year.
+
+    The metric columns are handled as one (rows x metrics) float block. factors holds one growth factor per
+    reference row and target year (NaN leaves the row unscaled) and is broadcast across the block. A model
+    forecast passes predictions instead, an array of reference rows x target years x metrics that replaces the
+    block. The result is indexed by each row's position in reference_data, so partial forecasts can be merged back
+    in a deterministic order. metrics names the metric columns (see metric_columns).
+    """
+    metrics = metric_columns(reference_data.columns, metrics)
+    # One forecast year is the reference window ordered by month; every target year repeats it.
+    months = reference_data['PERIOD_MONTH'].to_numpy()
+    month_positions = np.flatnonzero(np.isin(months, np.arange(1, 13)))
+    month_positions = month_positions[np.argsort(months[month_positions], kind='stable')]
+
+    years = np.arange(target_start_year, target_end_year + 1)
+    positions = np.tile(month_positions, len(years))
+    if len(positions) == 0:
+        return pd.DataFrame()
+
+    forecast_df = reference_data.iloc[positions].set_axis(positions)
+    forecast_df['PERIOD_YEAR'] = np.repeat(years, len(month_positions)).astype('int64')
+    forecast_df['PERIOD_MONTH'] = months[positions].astype('int64')
+
+    if predictions is not None:
+        block = predictions[month_positions].transpose(1, 0, 2).reshape(len(positions), -1)
+        forecast_df[metrics] = block
+        return forecast_df
+
+    factors = factors[month_positions].T.ravel()
+    mask = ~np.isnan(factors)
+    if mask.any() and metrics:
+        block = forecast_df[metrics].to_numpy(dtype='float64', copy=True)
+        block[mask] *= factors[mask, None]
+        forecast_df[metrics] = block
+
+    # iterrows() hands the loop engine float rows when every column is numeric, so its output is all float.
+    dtypes = reference_data.dtypes.tolist()
+    if all(isinstance(dtype, np.dtype) and dtype.kind in 'iuf' for dtype in dtypes):
+        row_dtype = np.result_type(*dtypes)
+        if row_dtype.kind == 'f':
+            forecast_df = forecast_df.astype(row_dtype)
+
+    return forecast_df
+
+
+def iter_forecast_blocks(reference_data, factors, target_start_year, target_end_year, metrics=None):
+    """Yields the forecast one (year, month) block at a time, in the order of forecast_reference_rows.
+
+    Only one block is alive at a time, so memory stays around the size of the reference window whatever the
+    horizon.
+    """
+    months = reference_data['PERIOD_MONTH'].to_numpy()
+    month_positions = {month: np.flatnonzero(months == month) for month in range(1, 13)}
+    for year in range(target_start_year, target_end_year + 1):
+        for month in range(1, 13):
+            positions = month_positions[month]
+            if len(positions):
+                yield forecast_reference_rows(reference_data.iloc[positions],
+                                              factors[positions][:, [year - target_start_year]], year, year,
+                                              metrics=metrics)
+
+
+def calculate_forecast_vectorized(source, references_month, references_year, target_start_year, target_end_year,
+                                  specifics_enabled, prod_nums, bus_chanl_nums):
+    """Same forecast as calculate_forecast, built with joins and array operations instead of iterrows()."""
+    source = as_audience_source(source)
+    reference_data = select_reference_data(source, references_month, references_year, specifics_enabled, prod_nums,
+                                           bus_chanl_nums)
+    if reference_data is None:
+        return pd.DataFrame(), pd.DataFrame()
+
+    print("Calculating reference growth factors...")
+    factors = align_growth_factors(compute_growth_factors(reference_data, target_start_year, target_end_year),
+                                   reference_data)
+
+    print("Starting forecast calculation...")
+    forecast_df = forecast_reference_rows(reference_data, factors, target_start_year, target_end_year,
+                                          metrics=source.metrics)
+
+    print(f"Forecast calculation completed. Total forecast rows: {len(forecast_df)}")
+    return forecast_df.reset_index(drop=True), reference_data
+
+
+def merge_forecast_parts(parts):
+    """Concatenates partial forecasts indexed by reference ordinal into the single-process row order."""
+    forecast_df = pd.concat(parts)
+    order = np.lexsort((forecast_df.index.to_numpy(), forecast_df['PERIOD_MONTH'].to_numpy(),
+                        forecast_df['PERIOD_YEAR'].to_numpy()))
+    return forecast_df.iloc[order].reset_index(drop=True)
+
+
+def forecast_shard(reference_shard, factors, ordinals, target_start_year, target_end_year, metrics=None):
+    """Process-pool worker: forecasts one shard and re-labels its rows with their ordinals in the full window."""
+    forecast_df = forecast_reference_rows(reference_shard, factors, target_start_year, target_end_year,
+                                          metrics=metrics)
+    return forecast_df.set_axis(ordinals[forecast_df.index.to_numpy(dtype='int64')])
+
+
+def calculate_forecast_parallel(source, references_month, references_year, target_start_year, target_end_year,
+                                specifics_enabled, prod_nums, bus_chanl_nums, workers=None,
+                                partition_column='PROD_NUM'):
+    """Vectorized forecast run over hash partitions of the reference window in a process pool.
+
+    Rows are sharded on partition_column (PROD_NUM or BUS_CHANL_NUM) and the shards are merged back in the
+    single-process order, so the result is identical to calculate_forecast_vectorized.
+    """
+    source = as_audience_source(source)
+    reference_data = select_reference_data(source, references_month, references_year, specifics_enabled, prod_nums,
+                                           bus_chanl_nums)
+    if reference_data is None:
+        return pd.DataFrame(), pd.DataFrame()
+
+    print("Calculating reference growth factors...")
+    factors = align_growth_factors(compute_growth_factors(reference_data, target_start_year, target_end_year),
+                                   reference_data)
+
+    workers = max(1, int(workers or os.cpu_count() or 1))
+    shard_ids = pd.util.hash_pandas_object(reference_data[partition_column], index=False).to_numpy() % workers
+    shards = [np.flatnonzero(shard_ids == shard_id) for shard_id in range(workers)]
+    shards = [positions for positions in shards if len(positions)]
+
+    print(f"Starting forecast calculation on {len(shards)} shards with {workers} workers...")
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(forecast_shard, reference_data.iloc[positions], factors[positions], positions,
+                                   target_start_year, target_end_year, source.metrics)
+                   for positions in shards]
+        parts = [future.result() for future in futures]
+    parts = [part for part in parts if not part.empty]
+    if not parts:
+        print("Forecast calculation completed. Total forecast rows: 0")
+        return pd.DataFrame(), reference_data
+
+    forecast_df = merge_forecast_parts(parts)
+    print(f"Forecast calculation completed. Total forecast rows: {len(forecast_df)}")
+    return forecast_df, reference_data
+
+
+def calculate_forecast_many(source, scenarios):
+    """Forecasts several scenarios from one loaded source.
+
+    Each scenario is a dict of forecast_parameters(). Reference windows and their growth factors (over every target
+    year the window's scenarios need) are built once per (references_month, references_year) and shared by every
+    scenario that uses them. Returns one
+    (forecast_df, reference_df) pair per scenario, empty when the scenario's selection has duplicate keys.
+    """
+    source = as_audience_source(source)
+    target_ranges = {}
+    for scenario in scenarios:
+        window_key = (scenario['references_month'], scenario['references_year'])
+        first, last = target_ranges.get(window_key, (scenario['target_start_year'], scenario['target_end_year']))
+        target_ranges[window_key] = (min(first, scenario['target_start_year']),
+                                     max(last, scenario['target_end_year']))
+
+    windows = {}
+    results = []
+    for scenario in scenarios:
+        window_key = (scenario['references_month'], scenario['references_year'])
+        if window_key not in windows:
+            print(f"Preparing reference window {window_key[0]:02d}-{window_key[1]}...")
+            window = source.reference_window(*window_key)
+            windows[window_key] = window, compute_growth_factors(window, *target_ranges[window_key])
+        window, growth_factors = windows[window_key]
+        growth_factors = growth_factors[list(range(scenario['target_start_year'],
+                                                   scenario['target_end_year'] + 1))]
+
+        reference_data = filter_specifics(window, scenario['specifics_enabled'], scenario['prod_nums'],
+                                          scenario['bus_chanl_nums'],
+                                          source.id_encodings if scenario['specifics_enabled'] else None)
+        if has_duplicate_keys(reference_data):
+            results.append((pd.DataFrame(), pd.DataFrame()))
+            continue
+
+        factors = align_growth_factors(growth_factors, reference_data)
+        forecast_df = forecast_reference_rows(reference_data, factors, scenario['target_start_year'],
+                                              scenario['target_end_year'], metrics=source.metrics)
+        print(f"Scenario forecast completed. Total forecast rows: {len(forecast_df)}")
+        results.append((forecast_df.reset_index(drop=True), reference_data))
+    return results
+
+
+def series_fingerprints(reference_data):
+    """One 64-bit fingerprint per (PROD_NUM, BUS_CHANL_NUM) series, summed over the hashes of its reference rows."""
+    row_hashes = pd.util.hash_pandas_object(reference_data, index=False)
+    keys = [reference_data[column] for column in ID_COLUMNS]
+    return row_hashes.groupby(keys, dropna=False, observed=True).sum()
+
+
+def series_mask(reference_data, series):
+    """Boolean mask of the reference rows belonging to one of the given (PROD_NUM, BUS_CHANL_NUM) series."""
+    keys = pd.MultiIndex.from_frame(reference_data[ID_COLUMNS])
+    return keys.isin(series)
+
+
+def calculate_forecast_incremental(source, references_month, references_year, target_start_year, target_end_year,
+                                   specifics_enabled, prod_nums, bus_chanl_nums, state_dir=None):
+    """Vectorized forecast that only recomputes the series whose reference rows changed since the previous run.
+
+    The previous run's series fingerprints and forecast are kept in state_dir, one state file per parameter set,
+    metric columns and metric dtypes (float32_minutes), so a state is never spliced into a differently scaled run.
+    Unchanged series are spliced from the previous forecast; new and changed series are recomputed and series that
+    disappeared are dropped.
+    """
+    parameters = {
+        'references_month': references_month, 'references_year': references_year,
+        'target_start_year': target_start_year, 'target_end_year': target_end_year,
+        'specifics_enabled': specifics_enabled, 'prod_nums': prod_nums, 'bus_chanl_nums': bus_chanl_nums,
+    }
+    source = as_audience_source(source)
+    reference_data = select_reference_data(source, references_month, references_year, specifics_enabled, prod_nums,
+                                           bus_chanl_nums)
+    if reference_data is None:
+        return pd.DataFrame(), pd.DataFrame()
+
+    fingerprints = series_fingerprints(reference_data)
+    state_key = {**parameters, 'metrics': [str(col) for col in source.metrics],
+                 'metric_dtypes': [str(dtype) for dtype in reference_data[source.metrics].dtypes]}
+    state_path = os.path.join(state_dir, f"incremental_{parameters_digest(state_key)}.pkl")
+    previous = pd.read_pickle(state_path) if os.path.isfile(state_path) else None
+
+    if previous is None or previous['forecast'].empty:
+        print("No previous forecast state, computing every series...")
+        recompute = np.ones(len(reference_data), dtype=bool)
+        parts = []
+    else:
+        previous_fingerprints = previous['fingerprints'].reindex(fingerprints.index)
+        changed = fingerprints.index[previous_fingerprints.isna() | (previous_fingerprints != fingerprints)]
+        print(f"{len(changed)} of {len(fingerprints)} series changed since the previous run.")
+        recompute = series_mask(reference_data, changed)
+
+        # Unchanged series keep their previous rows, re-labelled with the ordinal of their reference row.
+        previous_forecast = previous['forecast']
+        kept = previous_forecast[series_mask(previous_forecast, fingerprints.index.difference(changed))]
+        reference_keys = pd.MultiIndex.from_frame(reference_data[['PERIOD_MONTH'] + ID_COLUMNS])
+        ordinals = reference_keys.get_indexer(pd.MultiIndex.from_frame(kept[['PERIOD_MONTH'] + ID_COLUMNS]))
+        parts = [kept.set_axis(ordinals)]
+
+    positions = np.flatnonzero(recompute)
+    if len(positions):
+        changed_data = reference_data.iloc[positions]
+        factors = align_growth_factors(compute_growth_factors(changed_data, target_start_year, target_end_year),
+                                       changed_data)
+        parts.append(forecast_shard(changed_data, factors, positions, target_start_year, target_end_year,
+                                    source.metrics))
+
+    parts = [part for part in parts if not part.empty]
+    forecast_df = merge_forecast_parts(parts) if parts else pd.DataFrame()
+
+    os.makedirs(state_dir, exist_ok=True)
+    pd.to_pickle({'fingerprints': fingerprints, 'forecast': forecast_df}, state_path)
+    print(f"Forecast calculation completed. Total forecast rows: {len(forecast_df)}")
+    return forecast_df, reference_data
+
+
+def series_history(source, reference_data, references_month, references_year, columns=None):
+    """Series x period x viewing-minutes array of the whole history up to the reference month.
+
+    The series are the (PROD_NUM, BUS_CHANL_NUM) pairs of reference_data. Periods run from the earliest period any
+    of them appears in up to the reference month, and months without a row are NaN. columns replaces the
+    viewing-minutes columns with others, e.g. the sum_eop_vol_YYYY columns. Returns (series, first_key, history).
+    """
+    source = as_audience_source(source)
+    series = pd.MultiIndex.from_frame(reference_data[ID_COLUMNS]).unique()
+    reference_key = period_key(references_year, references_month)
+    rows = source.df.iloc[source.period_positions(np.iinfo('int64').min, reference_key)]
+
+    codes = series.get_indexer(pd.MultiIndex.from_frame(rows[ID_COLUMNS]))
+    keys = period_key(rows['PERIOD_YEAR'].to_numpy(dtype='int64'), rows['PERIOD_MONTH'].to_numpy(dtype='int64'))
+    keep = codes >= 0
+    codes, keys = codes[keep], keys[keep]
+    metrics = source.metrics if columns is None else list(columns)
+    values = np.nan_to_num(rows[metrics].to_numpy(dtype='float64')[keep])
+
+    first_key = int(keys.min()) if len(keys) else reference_key
+    n_periods = reference_key - first_key + 1
+    cells = codes * n_periods + (keys - first_key)
+    observed = np.bincount(cells, minlength=len(series) * n_periods) > 0
+    history = np.full((len(series) * n_periods, len(metrics)), np.nan)
+    for index in range(len(metrics)):
+        sums = np.bincount(cells, weights=values[:, index], minlength=len(series) * n_periods)
+        history[observed, index] = sums[observed]
+    return series, first_key, history.reshape(len(series), n_periods, -1)
+
+
+def trend_seasonal_design(keys, first_key):
+    """Design rows for the given period keys: intercept, months since first_key and 11 month-of-year dummies."""
+    keys = np.asarray(keys, dtype='int64')
+    months = (keys - 1) % 12 + 1
+    columns = [np.ones(len(keys)), (keys - first_key).astype('float64')]
+    columns += [(months == month).astype('float64') for month in range(2, 13)]
+    return np.column_stack(columns)
+
+
+def fit_trend_seasonal(history, first_key, target_keys):
+    """Linear trend plus monthly seasonality, fitted to every series and viewing-minutes column at once.
+
+    All series share one design matrix; a series' missing months get zero weight. Each series' weighted normal
+    equations come out of a single matrix product over the series x period weights, and all of them are solved
+    with one batched pseudo-inverse. Returns series x target period x column predictions, floored at zero.
+    """
+    n_series, n_periods, n_metrics = history.shape
+    design = trend_seasonal_design(first_key + np.arange(n_periods), first_key)
+    weights = (~np.isnan(history[..., 0])).astype('float64')
+    values = np.nan_to_num(history)
+
+    n_params = design.shape[1]
+    outer = np.einsum('tp,tq->tpq', design, design).reshape(n_periods, -1)
+    gram = (weights @ outer).reshape(n_series, n_params, n_params)
+    moments = np.stack([(weights * values[..., index]) @ design for index in range(n_metrics)], axis=-1)
+    coefficients = np.linalg.pinv(gram) @ moments
+
+    predictions = np.einsum('hp,spk->shk', trend_seasonal_design(target_keys, first_key), coefficients)
+    return np.maximum(predictions, 0.0)
+
+
+def observed_mean(history):
+    """Mean over the period axis of a series x period x column array, ignoring NaN; 0 where nothing is observed."""
+    counts = (~np.isnan(history)).sum(axis=1)
+    return np.nan_to_num(history).sum(axis=1) / np.maximum(counts, 1)
+
+
+HOLT_WINTERS_GRID = {'alpha': [0.2, 0.5, 0.8], 'beta': [0.05, 0.2], 'gamma': [0.1, 0.3]}
+
+
+def holt_winters_pass(history, first_key, alpha, beta, gamma, residuals=None):
+    """One Holt-Winters recursion over the period axis of a series x period x column history.
+
+    alpha, beta and gamma broadcast against the (combinations, series, column) state. Returns the final level, trend
+    and seasonals with the squared one-step-ahead errors after the first year per (combination, series). With a
+    single combination, residuals (an array shaped like history) receives those one-step-ahead errors, NaN where
+    nothing was observed or during the first year.
+    """
+    n_series, n_periods, n_metrics = history.shape
+    first_year = history[:, :12]
+    level = observed_mean(first_year)
+    trend = np.zeros_like(level)
+    if n_periods >= 24:
+        trend = (observed_mean(history[:, 12:24]) - level) / 12
+    seasonals = np.zeros((12, n_series, n_metrics))
+    for offset in range(min(12, n_periods)):
+        seasonals[(first_key + offset - 1) % 12] = np.nan_to_num(first_year[:, offset] - level)
+
+    shape = np.broadcast_shapes(np.shape(alpha), np.shape(beta), np.shape(gamma), (1, n_series, n_metrics))
+    level = np.broadcast_to(level, shape).copy()
+    trend = np.broadcast_to(trend, shape).copy()
+    seasonals = np.broadcast_to(seasonals[:, None], (12,) + shape).copy()
+    errors = np.zeros(shape[:2])
+
+    for offset in range(n_periods):
+        month_slot = (first_key + offset - 1) % 12
+        observation = history[:, offset]
+        observed = ~np.isnan(observation)
+        observation = np.nan_to_num(observation)
+        seasonal = seasonals[month_slot]
+        if offset >= 12:
+            residual = np.where(observed, observation - (level + trend + seasonal), 0.0)
+            errors += (residual ** 2).sum(axis=-1)
+            if residuals is not None:
+                residuals[:, offset] = np.where(observed, residual[0], np.nan)
+
+        new_level = alpha * (observation - seasonal) + (1 - alpha) * (level + trend)
+        new_level = np.where(observed, new_level, level + trend)
+        trend = np.where(observed, beta * (new_level - level) + (1 - beta) * trend, trend)
+        seasonals[month_slot] = np.where(observed, gamma * (observation - new_level) + (1 - gamma) * seasonal,
+                                         seasonal)
+        level = new_level
+    return level, trend, seasonals, errors
+
+
+def holt_winters_combinations(smoothing=None, smoothing_grid=None):
+    """3 x combinations array of (alpha, beta, gamma): the fixed smoothing, or every point of the grid."""
+    if smoothing:
+        grid = {name: [float(smoothing[name])] for name in ('alpha', 'beta', 'gamma')}
+    else:
+        grid = smoothing_grid or HOLT_WINTERS_GRID
+    return np.array(np.meshgrid(grid['alpha'], grid['beta'], grid['gamma'], indexing='ij'),
+                    dtype='float64').reshape(3, -1)
+
+
+def smoothing_errors(smoothing=None, smoothing_grid=None):
+    """What is wrong with holt_winters smoothing options: smoothing needs a number in [0, 1] for each of alpha, beta
+    and gamma, and smoothing_grid a non-empty list of them. Empty when both are usable."""
+    def valid(value):
+        return isinstance(value, (int, float)) and not isinstance(value, bool) and 0 <= value <= 1
+
+    errors = []
+    for option, values in (('smoothing', smoothing), ('smoothing_grid', smoothing_grid)):
+        if values is None:
+            continue
+        if not isinstance(values, dict):
+            errors.append(f"{option} must map alpha, beta and gamma to values")
+            continue
+        for name in ('alpha', 'beta', 'gamma'):
+            value = values.get(name)
+            if option == 'smoothing' and not valid(value):
+                errors.append(f"{option}['{name}'] must be a number in [0, 1], not {value!r}")
+            elif option == 'smoothing_grid' and not (isinstance(value, list) and value and all(map(valid, value))):
+                errors.append(f"{option}['{name}'] must be a non-empty list of numbers in [0, 1], not {value!r}")
+    return errors
+
+
+def fit_holt_winters(history, first_key, target_keys, smoothing=None, smoothing_grid=None):
+    """Additive Holt-Winters smoothing of every series and viewing-minutes column in one recursion.
+
+    The state (level, trend and 12 month-of-year seasonals) is a stack of arrays indexed by parameter combination,
+    series and column. Each time step advances all of them together, and months without a row only carry the
+    state forward. smoothing fixes alpha, beta and gamma. Otherwise every combination of smoothing_grid
+    (HOLT_WINTERS_GRID by default) runs in the same pass, and each series keeps the combination with the lowest
+    one-step-ahead squared error after its first year.
+    """
+    combinations = holt_winters_combinations(smoothing, smoothing_grid)
+    alpha, beta, gamma = (parameter[:, None, None] for parameter in combinations)
+
+    n_series, n_periods, n_metrics = history.shape
+    level, trend, seasonals, errors = holt_winters_pass(history, first_key, alpha, beta, gamma)
+
+    best = errors.argmin(axis=0)
+    series_index = np.arange(n_series)
+    level, trend = level[best, series_index], trend[best, series_index]
+    seasonals = seasonals[:, best, series_index]
+
+    target_keys = np.asarray(target_keys, dtype='int64')
+    horizons = (target_keys - (first_key + n_periods - 1)).astype('float64')
+    predictions = (level[:, None] + horizons[None, :, None] * trend[:, None]
+                   + seasonals[(target_keys - 1) % 12].transpose(1, 0, 2))
+    return np.maximum(predictions, 0.0)
+
+
+FORECAST_MODELS = {
+    'trend_seasonal': fit_trend_seasonal,
+    'holt_winters': fit_holt_winters,
+}
+
+
+def calculate_forecast_model(source, references_month, references_year, target_start_year, target_end_year,
+                             specifics_enabled, prod_nums, bus_chanl_nums, model='trend_seasonal', **model_options):
+    """Forecast from one of FORECAST_MODELS, fitted on the full history of every series in the reference window.
+
+    The output has the same rows as the ratio forecast; only the viewing-minutes columns come from the model.
+    """
+    source = as_audience_source(source)
+    reference_data = select_reference_data(source, references_month, references_year, specifics_enabled, prod_nums,
+                                           bus_chanl_nums)
+    if reference_data is None:
+        return pd.DataFrame(), pd.DataFrame()
+
+    print(f"Fitting the {model} model...")
+    series, first_key, history = series_history(source, reference_data, references_month, references_year)
+    n_years = target_end_year - target_start_year + 1
+    target_keys = period_key(np.repeat(np.arange(target_start_year, target_end_year + 1), 12),
+                             np.tile(np.arange(1, 13), n_years))
+    predictions = FORECAST_MODELS[model](history, first_key, target_keys, **model_options)
+
+    # Each reference row takes the prediction of its series for its month in every target year.
+    codes = series.get_indexer(pd.MultiIndex.from_frame(reference_data[ID_COLUMNS]))
+    months = np.clip(reference_data['PERIOD_MONTH'].to_numpy(dtype='int64'), 1, 12)
+    targets = np.arange(n_years)[None, :] * 12 + months[:, None] - 1
+    row_predictions = predictions[codes[:, None], targets]
+
+    print("Starting forecast calculation...")
+    forecast_df = forecast_reference_rows(reference_data, None, target_start_year, target_end_year,
+                                          predictions=row_predictions, metrics=source.metrics)
+    print(f"Forecast calculation completed. Total forecast rows: {len(forecast_df)}")
+    return forecast_df.reset_index(drop=True), reference_data
+
+
+INACTIVE_SERIES_POLICIES = {'zeros', 'exclude'}
+
+
+def series_codes(df, encodings):
+    """One integer per (PROD_NUM, BUS_CHANL_NUM) pair of df, from the IdEncoding codes of both columns."""
+    prod_codes = encodings['PROD_NUM'].codes(df['PROD_NUM']).astype('int64') + 1
+    chanl_codes = encodings['BUS_CHANL_NUM'].codes(df['BUS_CHANL_NUM']).astype('int64') + 1
+    return prod_codes * (len(encodings['BUS_CHANL_NUM'].labels) + 1) + chanl_codes
+
+
+def calculate_forecast_active(source, references_month, references_year, target_start_year, target_end_year,
+                              specifics_enabled, prod_nums, bus_chanl_nums, forecast_function=None,
+                              inactive_series='zeros', **engine_options):
+    """Runs forecast_function on the active series only.
+
+    A series is inactive when none of its reference-window rows has non-zero minutes. Its rows are dropped from
+    the source before the engine runs. With 'zeros' they come back as forecast rows with zero minutes, in the usual
+    row order. With 'exclude' they are left out of the forecast and the Reference sheet.
+    """
+    forecast_function = forecast_function or calculate_forecast_vectorized
+    parameters = dict(references_month=references_month, references_year=references_year,
+                      target_start_year=target_start_year, target_end_year=target_end_year,
+                      specifics_enabled=specifics_enabled, prod_nums=prod_nums, bus_chanl_nums=bus_chanl_nums)
+    source = as_audience_source(source)
+    reference_data = select_reference_data(source, references_month, references_year, specifics_enabled, prod_nums,
+                                           bus_chanl_nums)
+    if reference_data is None or reference_data.empty:
+        return pd.DataFrame(), pd.DataFrame()
+
+    metrics = source.metrics
+    activity = np.abs(np.nan_to_num(reference_data[metrics].to_numpy(dtype='float64'))).sum(axis=1)
+    codes, inverse = np.unique(series_codes(reference_data, source.id_encodings), return_inverse=True)
+    active_series = np.bincount(inverse, weights=activity, minlength=len(codes)) > 0
+    n_inactive = int((~active_series).sum())
+    logging.info(f"{n_inactive} of {len(codes)} series have no minutes in the reference window "
+                 f"({'emitted as zeros' if inactive_series == 'zeros' else 'excluded'})")
+    if n_inactive == 0:
+        return forecast_function(source, **parameters, **engine_options)
+
+    keep = ~np.isin(series_codes(source.df, source.id_encodings), codes[~active_series])
+    if keep.any():
+        forecast_df, active_reference = forecast_function(AudienceSource(source.df[keep], metrics), **parameters,
+                                                          **engine_options)
+    else:
+        forecast_df, active_reference = pd.DataFrame(), reference_data.iloc[:0]
+    if inactive_series == 'exclude':
+        return forecast_df, active_reference
+
+    # The engine's rows follow (year, month, position among the active reference rows); label them with their
+    # positions in the full window so the zero rows can be merged in between.
+    active = active_series[inverse]
+    months = reference_data['PERIOD_MONTH'].to_numpy()
+    in_year = np.isin(months, np.arange(1, 13))
+    active_positions = np.flatnonzero(active & in_year)
+    active_positions = active_positions[np.argsort(months[active_positions], kind='stable')]
+    n_years = target_end_year - target_start_year + 1
+    if len(forecast_df) != len(active_positions) * n_years:
+        logging.error("Active forecast rows do not line up with the reference window.")
+        return pd.DataFrame(), pd.DataFrame()
+    parts = [forecast_df.set_axis(np.tile(active_positions, n_years))] if len(forecast_df) else []
+
+    inactive_positions = np.flatnonzero(~active)
+    zero_rows = forecast_shard(reference_data.iloc[inactive_positions],
+                               np.full((len(inactive_positions), n_years), np.nan), inactive_positions,
+                               target_start_year, target_end_year, metrics)
+    if len(zero_rows):
+        zero_rows[metrics] = 0.0
+        parts.append(zero_rows)
+    if not parts:
+        return pd.DataFrame(), reference_data
+    return merge_forecast_parts(parts), reference_data
+
+
+def ratio_residuals(source, reference_data, references_month, references_year):
+    """In-sample one-year-ahead errors of the ratio model: y_t - step_t * y_t-12 for every series and column.
+
+    step_t is sum_eop_vol_Y / sum_eop_vol_(Y-1) of the row a year earlier, Y being the year of t, and 1 when that
+    step does not apply (the same rules as growth_factors_from_volumes). Returns (series, residuals), the residuals
+    shaped like series_history and NaN where either month is missing.
+    """
+    series, first_key, history = series_history(source, reference_data, references_month, references_year)
+    n_periods = history.shape[1]
+    if n_periods <= 12:
+        return series, history[:, :0]
+
+    volume_columns = eop_volume_columns(reference_data.columns)
+    steps = np.ones(history.shape[:2])
+    if volume_columns:
+        _, _, volumes = series_history(source, reference_data, references_month, references_year,
+                                       columns=volume_columns.values())
+        volume_years = list(volume_columns)
+        years = (first_key + np.arange(n_periods) - 1) // 12
+        for offset in range(12, n_periods):
+            year = int(years[offset])
+            if year in volume_columns and year - 1 in volume_columns:
+                base = volumes[:, offset - 12]
+                previous, current = base[:, volume_years.index(year - 1)], base[:, volume_years.index(year)]
+                valid = ~np.isnan(previous) & (previous != 0) & ~np.isnan(current)
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    steps[:, offset] = np.where(valid, current / previous, 1.0)
+    return series, history[:, 12:] - steps[:, 12:, None] * history[:, :-12]
+
+
+def model_residuals(source, reference_data, references_month, references_year, model='ratio', model_options=None):
+    """In-sample residuals of a forecast model for every series of reference_data: (series, residuals).
+
+    The ratio model uses ratio_residuals. trend_seasonal takes the history minus its fitted values (none for series
+    it fits exactly) and holt_winters its one-step-ahead errors with each series' chosen smoothing. Residuals are
+    NaN where the history has no observation.
+    """
+    if model == 'ratio':
+        return ratio_residuals(source, reference_data, references_month, references_year)
+
+    model_options = model_options or {}
+    series, first_key, history = series_history(source, reference_data, references_month, references_year)
+    n_periods = history.shape[1]
+    if model == 'trend_seasonal':
+        fitted = fit_trend_seasonal(history, first_key, first_key + np.arange(n_periods))
+        residuals = history - fitted
+        # A series with no more months than the design has parameters is fitted exactly: no usable residual.
+        n_params = trend_seasonal_design([first_key], first_key).shape[1]
+        residuals[(~np.isnan(history[..., 0])).sum(axis=1) <= n_params] = np.nan
+        return series, residuals
+
+    combinations = holt_winters_combinations(model_options.get('smoothing'), model_options.get('smoothing_grid'))
+    errors = holt_winters_pass(history, first_key, *(parameter[:, None, None] for parameter in combinations))[3]
+    best = combinations[:, errors.argmin(axis=0)]
+    residuals = np.full_like(history, np.nan)
+    holt_winters_pass(history, first_key, *(parameter[None, :, None] for parameter in best), residuals=residuals)
+    return series, residuals
+
+
+INTERVAL_QUANTILES = {'P10': 0.1, 'P50': 0.5, 'P90': 0.9}
+
+
+def add_prediction_intervals(forecast_df, source, reference_data, references_month, references_year, samples=200,
+                             seed=0, model='ratio', model_options=None):
+    """Adds <column>_P10/_P50/_P90 bands around every viewing-minutes column of forecast_df.
+
+    A residual bootstrap of the model's in-sample residuals (model_residuals). A target month h years past its
+    reference month accumulates h residuals drawn with replacement from its series, so the bands widen with the
+    horizon. The bands are centred on the point forecast: P50 is the point itself, and P10/P90 add the spread of
+    the draws' quantiles around their median, floored at zero. All series are drawn together, so the work grows
+    with samples x series x horizons, not with forecast rows. Series without any residual get NaN bands.
+    """
+    series, residuals = model_residuals(source, reference_data, references_month, references_year, model,
+                                        model_options)
+    metrics = as_audience_source(source).metrics
+    forecast_df = forecast_df.copy()
+    codes = series.get_indexer(pd.MultiIndex.from_frame(forecast_df[ID_COLUMNS]))
+    reference_key = period_key(references_year, references_month)
+    target_keys = period_key(forecast_df['PERIOD_YEAR'].to_numpy(dtype='int64'),
+                             forecast_df['PERIOD_MONTH'].to_numpy(dtype='int64'))
+    horizons = np.maximum(-((reference_key - target_keys) // 12), 1)
+    n_horizons = int(horizons.max()) if len(horizons) else 0
+
+    valid = ~np.isnan(residuals[..., 0]) if residuals.shape[1] else np.zeros((len(series), 0), dtype=bool)
+    counts = valid.sum(axis=1)
+    # spreads[h - 1, series, column, quantile]: band offsets from the median for h years ahead.
+    spreads = np.full((n_horizons, len(series), len(metrics), len(INTERVAL_QUANTILES)), np.nan)
+    if residuals.shape[1] and counts.any() and n_horizons:
+        # Move each series' usable residuals to the front so a draw is an index below its count.
+        order = np.argsort(~valid, axis=1, kind='stable')
+        residuals = np.take_along_axis(residuals, order[..., None], axis=1)
+        rng = np.random.default_rng(seed)
+        totals = np.zeros((samples, len(series), len(metrics)))
+        for horizon in range(n_horizons):
+            draws = np.minimum((rng.random((samples, len(series))) * counts).astype('int64'), residuals.shape[1] - 1)
+            totals += residuals[np.arange(len(series))[None, :], draws]
+            with np.errstate(invalid='ignore'):
+                quantiles = np.quantile(totals, list(INTERVAL_QUANTILES.values()) + [0.5], axis=0)
+            spreads[horizon] = (quantiles[:-1] - quantiles[-1]).transpose(1, 2, 0)
+        spreads[:, counts == 0] = np.nan
+
+    for index, col in enumerate(metrics):
+        point = forecast_df[col].to_numpy(dtype='float64')
+        for band_index, name in enumerate(INTERVAL_QUANTILES):
+            if len(series) and n_horizons:
+                offsets = spreads[horizons - 1, codes, index, band_index]
+            else:
+                offsets = np.full(len(point), np.nan)
+            forecast_df[f"{col}_{name}"] = np.maximum(point + offsets, 0.0)
+    return forecast_df
+
+
+FORECAST_ENGINES = {
+    'loop': calculate_forecast,
+    'vectorized': calculate_forecast_vectorized,
+    'parallel': calculate_forecast_parallel,
+    'incremental': calculate_forecast_incremental,
+}
+
 
 def copy_sheet(source_sheet, target_sheet):
     for row in source_sheet.iter_rows():
@@ -139,26 +1329,47 @@ def check_file_open(file_path):
         return True
     return False
 
+
+def output_file(output_path, output_filename):
+    """Path of output_filename in output_path, created if needed; None (logged) when the file is open elsewhere."""
+    if not os.path.exists(output_path):
+        os.makedirs(output_path)
+
+    output_filepath = os.path.join(output_path, output_filename)
+    if check_file_open(output_filepath):
+        logging.error(f"The file {output_filepath} is open. Please close the file and try again.")
+        return None
+    return output_filepath
+
+
+def write_frame(ws, df):
+    """Writes df with its header row to ws from A1 and freezes the header."""
+    for r_idx, row in enumerate(dataframe_to_rows(df, index=False, header=True), 1):
+        for c_idx, value in enumerate(row, 1):
+            ws.cell(row=r_idx, column=c_idx, value=value)
+    ws.freeze_panes = 'A2'
+
+HEADER_FILL = PatternFill(start_color="4ea72e", end_color="4ea72e", fill_type="solid")
+HEADER_FONT = Font(color="FFFFFF", bold=True)
+ALTERNATING_FILLS = [PatternFill(start_color="FFFFFF", end_color="FFFFFF", fill_type="solid"),
+                     PatternFill(start_color="daf2d0", end_color="daf2d0", fill_type="solid")]
+CELL_BORDER = Border(top=Side(style="thin", color="4ea72e"), bottom=Side(style="thin", color="4ea72e"))
+
+
 def style_worksheet(ws):
     ws.auto_filter.ref = ws.dimensions
 
-    header_fill = PatternFill(start_color="4ea72e", end_color="4ea72e", fill_type="solid")
-    header_font = Font(color="FFFFFF", bold=True)
-    alternating_fill = [PatternFill(start_color="FFFFFF", end_color="FFFFFF", fill_type="solid"),
-                        PatternFill(start_color="daf2d0", end_color="daf2d0", fill_type="solid")]
-    border = Border(top=Side(style="thin", color="4ea72e"), bottom=Side(style="thin", color="4ea72e"))
-
     max_row = ws.max_row
     max_col = ws.max_column
 
     for row in ws.iter_rows(min_row=1, max_row=max_row, min_col=1, max_col=max_col):
         for cell in row:
-            cell.border = border
+            cell.border = CELL_BORDER
             if cell.row == 1:
-                cell.fill = header_fill
-                cell.font = header_font
+                cell.fill = HEADER_FILL
+                cell.font = HEADER_FONT
             else:
-                cell.fill = alternating_fill[(cell.row - 2) % 2]
+                cell.fill = ALTERNATING_FILLS[(cell.row - 2) % 2]
 
     for col in ws.iter_cols(min_row=1, max_row=max_row, min_col=1, max_col=max_col):
         max_length = 0
@@ -169,39 +1380,295 @@ def style_worksheet(ws):
         adjusted_width = max_length + 2 if max_length > 0 else 8
         ws.column_dimensions[column_letter].width = adjusted_width
 
-def save_dataframe_with_formatting(forecast_df, reference_df, output_path, original_file, references_year, prod_nums, bus_chanl_nums):
-    if not os.path.exists(output_path):
-        os.makedirs(output_path)
+def write_streamed_sheet(workbook, title, blocks):
+    """Appends DataFrame blocks to a new write-only sheet, styled like style_worksheet.
 
-    output_filepath = os.path.join(output_path, "forecast_audience.xlsx")
+    Column widths are sized from the header and the first block, since later blocks are not known yet.
+    """
+    ws = workbook.create_sheet(title=title)
+    ws.freeze_panes = 'A2'
+    row_number = 0
+    max_col = 0
+    for block in blocks:
+        if row_number == 0:
+            header = [str(column) for column in block.columns]
+            max_col = len(header)
+            for col_idx, column in enumerate(block.columns, 1):
+                lengths = [len(header[col_idx - 1])] + [len(str(value)) for value in block[column].head(1000)
+                                                        if value is not None]
+                ws.column_dimensions[get_column_letter(col_idx)].width = max(lengths) + 2
+            cells = []
+            for value in header:
+                cell = WriteOnlyCell(ws, value=value)
+                cell.fill = HEADER_FILL
+                cell.font = HEADER_FONT
+                cell.border = CELL_BORDER
+                cells.append(cell)
+            ws.append(cells)
+            row_number = 1
 
-    if check_file_open(output_filepath):
-        logging.error(f"The file {output_filepath} is open. Please close the file and try again.")
+        for values in dataframe_to_rows(block, index=False, header=False):
+            row_number += 1
+            fill = ALTERNATING_FILLS[(row_number - 2) % 2]
+            cells = []
+            for value in values:
+                cell = WriteOnlyCell(ws, value=value)
+                cell.fill = fill
+                cell.border = CELL_BORDER
+                cells.append(cell)
+            ws.append(cells)
+
+    if row_number:
+        ws.auto_filter.ref = f"A1:{get_column_letter(max_col)}{row_number}"
+    return row_number
+
+
+def save_forecast_stream(forecast_blocks, reference_df, output_path, output_filename="forecast_audience.xlsx"):
+    """Writes forecast blocks straight into a write-only workbook, so the full forecast never sits in memory.
+
+    Unlike save_dataframe_with_formatting the workbook is built from scratch and holds only the Working and
+    Reference sheets.
+    """
+    output_filepath = output_file(output_path, output_filename)
+    if output_filepath is None:
         return
 
     try:
-        logging.info(f"Loading original workbook from {original_file}")
-        workbook = load_workbook(original_file)
+        workbook = Workbook(write_only=True)
+        logging.info("Streaming forecast blocks to the Working sheet")
+        rows = write_streamed_sheet(workbook, "Working", forecast_blocks)
+        logging.info("Writing data to the Reference sheet")
+        write_streamed_sheet(workbook, "Reference", [reference_df])
+
+        logging.info(f"Saving workbook to {output_filepath}")
+        workbook.save(output_filepath)
+        logging.info(f"Data saved to {output_filepath} ({max(rows - 1, 0)} forecast rows)")
+        return output_filepath
+
+    except Exception as e:
+        logging.error(f"An error occurred: {e}")
+
+
+GROUPINGS = {
+    'CHANNEL_GROUP': {'sheet': 'Content_Channel_Grouping', 'key': 'BUS_CHANNEL_ID', 'label': 'CHANNEL_NAME',
+                      'column': 'BUS_CHANL_NUM', 'title': 'Channel Group'},
+    'PRODUCT_GROUP': {'sheet': 'Content_Product_Grouping WS 241', 'key': 'PROD_NUM', 'label': 'LOOKUP_KEY',
+                      'column': 'PROD_NUM', 'title': 'Product Group'},
+}
+UNMAPPED_GROUP = "(unmapped)"
+
+
+def grouping_key(values):
+    """String form of IDs for joining with the grouping files: integral numbers such as 101.0 become '101'."""
+    values = pd.Series(np.asarray(values, dtype=object))
+    numeric = pd.to_numeric(values, errors='coerce')
+    integral = (numeric.notna() & (numeric == np.floor(numeric))).to_numpy()
+    keys = values.astype(str).to_numpy(dtype=object)
+    keys[integral] = numeric[integral].astype('int64').astype(str).to_numpy()
+    return keys
+
+
+def load_groupings(channel_grouping_src=None, product_grouping_src=None):
+    """{level: Series of group labels indexed by grouping_key} for each grouping file that can be read."""
+    groupings = {}
+    for level, src in (('CHANNEL_GROUP', channel_grouping_src), ('PRODUCT_GROUP', product_grouping_src)):
+        if not src:
+            continue
+        grouping = GROUPINGS[level]
+        try:
+            df = pd.read_excel(src, sheet_name=grouping['sheet'], usecols=[grouping['key'], grouping['label']])
+        except (OSError, ValueError) as e:
+            logging.warning(f"Could not read {grouping['sheet']} from {src}: {e}")
+            continue
+        df = df.dropna(subset=[grouping['key']])
+        labels = pd.Series(df[grouping['label']].to_numpy(), index=grouping_key(df[grouping['key']]))
+        groupings[level] = labels[~labels.index.duplicated()]
+    return groupings
+
+
+def group_labels(column, labels):
+    """Group label of every row of column, looked up once per distinct value."""
+    codes, uniques = pd.factorize(column)
+    mapped = labels.reindex(grouping_key(uniques)).fillna(UNMAPPED_GROUP).to_numpy(dtype=object)
+    return np.append(mapped, UNMAPPED_GROUP)[codes]
+
+
+def rollup_summary_sheets(forecast_df, groupings, metrics=None):
+    """{sheet title: frame} of monthly and yearly viewing-minutes totals for every group level.
+
+    The forecast rows go through a single groupby on (year, month, every group level). The per-level sheets are
+    rolled up from that small cube.
+    """
+    if not groupings or forecast_df.empty:
+        return {}
+    levels = list(groupings)
+    periods = ['PERIOD_YEAR', 'PERIOD_MONTH']
+    metrics = metric_columns(forecast_df.columns, metrics)
+    labelled = forecast_df[periods + metrics].assign(**{
+        level: group_labels(forecast_df[GROUPINGS[level]['column']], groupings[level]) for level in levels})
+    cube = labelled.groupby(periods + levels)[metrics].sum()
+
+    sheets = {}
+    for level in levels:
+        title = GROUPINGS[level]['title']
+        sheets[f"{title} Monthly"] = cube.groupby(level=periods + [level]).sum().reset_index()
+        sheets[f"{title} Yearly"] = cube.groupby(level=['PERIOD_YEAR', level]).sum().reset_index()
+    return sheets
+
+
+# Bottom-up group totals are the group rollup sheets (rollup_summary_sheets), so top-down is the only method.
+RECONCILIATION_METHODS = {'top_down'}
+TOTAL_LEVEL = 'TOTAL'
+
+
+def period_matrix(rows, n_rows, periods, n_periods, block):
+    """Sparse (n_rows x n_periods * metrics) matrix holding each row of block at (rows, periods)."""
+    n_metrics = block.shape[1]
+    columns = (periods[:, None] * n_metrics + np.arange(n_metrics)).ravel()
+    return sparse.csr_matrix((block.ravel(), (np.repeat(rows, n_metrics), columns)),
+                             shape=(n_rows, n_periods * n_metrics))
+
+
+class ForecastHierarchy:
+    """Channel and product group hierarchy over the series of a forecast.
+
+    The leaves are the (PROD_NUM, BUS_CHANL_NUM) series of forecast_df. Every level (TOTAL_LEVEL and each level of
+    groupings) has a sparse (groups x leaves) aggregation matrix, so aggregation @ leaf values gives the value of
+    every group of the level at once.
+    """
+
+    def __init__(self, forecast_df, groupings):
+        self.encodings = id_encodings(forecast_df)
+        self.leaf_codes, self.row_leaves = np.unique(series_codes(forecast_df, self.encodings), return_inverse=True)
+        n_leaves = len(self.leaf_codes)
+        chanl_count = len(self.encodings['BUS_CHANL_NUM'].labels) + 1
+        leaf_ids = {'PROD_NUM': self.leaf_codes // chanl_count - 1, 'BUS_CHANL_NUM': self.leaf_codes % chanl_count - 1}
+
+        self.groups = {TOTAL_LEVEL: (np.zeros(n_leaves, dtype='int64'), np.array([TOTAL_LEVEL], dtype=object))}
+        for level, labels in groupings.items():
+            column = GROUPINGS[level]['column']
+            ids = np.append(self.encodings[column].labels.to_numpy(dtype=object), None)[leaf_ids[column]]
+            self.groups[level] = pd.factorize(group_labels(ids, labels), sort=True)
+        self.aggregation = {
+            level: sparse.csr_matrix((np.ones(n_leaves), (codes, np.arange(n_leaves))), shape=(len(groups), n_leaves))
+            for level, (codes, groups) in self.groups.items()}
+
+    def leaves_of(self, df):
+        """Leaf of every row of df, and whether the row's series is a leaf at all."""
+        codes = series_codes(df, self.encodings)
+        leaves = np.minimum(np.searchsorted(self.leaf_codes, codes), max(len(self.leaf_codes) - 1, 0))
+        return leaves, self.leaf_codes[leaves] == codes
+
+
+def reconcile_top_down(forecast_df, reference_df, groupings, level=TOTAL_LEVEL, metrics=None, source=None,
+                       model='ratio', model_options=None):
+    """Proportional top-down reconciliation from an independent forecast of every group of level.
+
+    With the ratio model a group's forecast is its reference minutes for each calendar month, scaled by the growth
+    of its summed sum_eop_vol_YYYY columns (growth_factors_from_volumes). With one of FORECAST_MODELS the model is
+    fitted on the group's summed history from source (series_history), so the reconciled forecast keeps the
+    selected model. The group forecast is split across the group's series in their shares of the group's
+    reference minutes for that month, so the series add up to their group. Group values are sparse products of the
+    level's aggregation matrix with the series matrices, over all months and columns at once. Where a group has no
+    reference minutes for a month and column, its series keep their own forecast.
+    """
+    hierarchy = ForecastHierarchy(forecast_df, groupings)
+    metrics = metric_columns(forecast_df.columns, metrics)
+    aggregation = hierarchy.aggregation[level]
+    leaf_groups = hierarchy.groups[level][0]
+    n_leaves, n_metrics = len(hierarchy.leaf_codes), len(metrics)
+
+    reference_leaves, known = hierarchy.leaves_of(reference_df)
+    reference_leaves = reference_leaves[known]
+    reference = reference_df[known]
+    reference_months = reference['PERIOD_MONTH'].to_numpy(dtype='int64') - 1
+    reference_keys = period_key(reference['PERIOD_YEAR'].to_numpy(dtype='int64'), reference_months + 1)
+    month_keys = np.zeros(12, dtype='int64')
+    month_keys[reference_months] = reference_keys
+
+    def group_months(columns):
+        block = np.nan_to_num(reference[columns].to_numpy(dtype='float64'))
+        leaf_months = period_matrix(reference_leaves, n_leaves, reference_months, 12, block)
+        return leaf_months, (aggregation @ leaf_months).toarray().reshape(-1, 12, len(columns))
+
+    history, group_history = group_months(metrics)
+    leaf_history = history.toarray().reshape(n_leaves, 12, n_metrics)
+    n_groups = group_history.shape[0]
+    years = forecast_df['PERIOD_YEAR'].to_numpy(dtype='int64')
+    months = forecast_df['PERIOD_MONTH'].to_numpy(dtype='int64') - 1
+    target_start_year, target_end_year = int(years.min()), int(years.max())
+    row_groups = leaf_groups[hierarchy.row_leaves]
+    totals = group_history[row_groups, months]
+
+    if model == 'ratio':
+        volume_columns = list(eop_volume_columns(reference_df.columns).values())
+        _, group_volumes = group_months(volume_columns)
+        volumes = pd.DataFrame(group_volumes.reshape(n_groups * 12, -1), columns=volume_columns,
+                               index=pd.MultiIndex.from_arrays([np.repeat(np.arange(n_groups), 12),
+                                                                np.tile(month_keys, n_groups)],
+                                                               names=['GROUP', 'PERIOD_KEY']))
+        factors = growth_factors_from_volumes(volumes, target_start_year, target_end_year).to_numpy()
+        factors = np.nan_to_num(factors, nan=1.0).reshape(n_groups, 12, -1)
+        group_forecast = totals * factors[row_groups, months, years - target_start_year][:, None]
+    else:
+        reference_key = int(reference_keys.max())
+        series, first_key, series_values = series_history(source, reference, (reference_key - 1) % 12 + 1,
+                                                          (reference_key - 1) // 12, columns=metrics)
+        series_leaves, series_known = hierarchy.leaves_of(series.to_frame(index=False))
+        series_aggregation = aggregation[:, series_leaves[series_known]]
+        series_values = series_values[series_known]
+        n_periods = series_values.shape[1]
+        # A group month is missing only when none of its series has it.
+        group_sums = series_aggregation @ np.nan_to_num(series_values).reshape(len(series_values), -1)
+        observed = series_aggregation @ (~np.isnan(series_values)).reshape(len(series_values), -1).astype('float64')
+        group_series = np.where(observed > 0, group_sums, np.nan).reshape(n_groups, n_periods, n_metrics)
+        n_years = target_end_year - target_start_year + 1
+        target_keys = period_key(np.repeat(np.arange(target_start_year, target_end_year + 1), 12),
+                                 np.tile(np.arange(1, 13), n_years))
+        predictions = FORECAST_MODELS[model](group_series, first_key, target_keys, **(model_options or {}))
+        group_forecast = predictions[row_groups, (years - target_start_year) * 12 + months]
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        shares = leaf_history[hierarchy.row_leaves, months] / totals
+    forecast_df = forecast_df.copy()
+    forecast_df[metrics] = np.where(totals != 0, group_forecast * shares,
+                                    forecast_df[metrics].to_numpy(dtype='float64'))
+    return forecast_df
+
+
+def save_dataframe_with_formatting(forecast_df, reference_df, output_path, original_file, references_year, prod_nums, bus_chanl_nums,
+                                   output_filename="forecast_audience.xlsx", summary_sheets=None):
+    output_filepath = output_file(output_path, output_filename)
+    if output_filepath is None:
+        return
+
+    try:
+        if original_file:
+            logging.info(f"Loading original workbook from {original_file}")
+            workbook = load_workbook(original_file)
+        else:
+            workbook = Workbook()
         reference_sheet = workbook.active
 
         forecast_sheet = workbook.create_sheet(title="Working")
         new_reference_sheet = workbook.create_sheet(title="Reference")
 
         logging.info("Writing data to the Working sheet")
-        for r_idx, row in enumerate(dataframe_to_rows(forecast_df, index=False, header=True), 1):
-            for c_idx, value in enumerate(row, 1):
-                forecast_sheet.cell(row=r_idx, column=c_idx, value=value)
+        write_frame(forecast_sheet, forecast_df)
 
         logging.info("Writing data to the Reference sheet")
-        for r_idx, row in enumerate(dataframe_to_rows(reference_df, index=False, header=True), 1):
-            for c_idx, value in enumerate(row, 1):
-                new_reference_sheet.cell(row=r_idx, column=c_idx, value=value)
+        write_frame(new_reference_sheet, reference_df)
+
+        styled_sheets = [forecast_sheet, new_reference_sheet]
 
-        forecast_sheet.freeze_panes = 'A2'
-        new_reference_sheet.freeze_panes = 'A2'
+        for title, summary_df in (summary_sheets or {}).items():
+            logging.info(f"Writing data to the {title} sheet")
+            summary_sheet = workbook.create_sheet(title=title)
+            write_frame(summary_sheet, summary_df)
+            styled_sheets.append(summary_sheet)
 
         logging.info("Adjusting column widths and applying styles")
-        for sheet in [forecast_sheet, new_reference_sheet]:
+        for sheet in styled_sheets:
             style_worksheet(sheet)
 
         workbook.remove(reference_sheet)
@@ -216,6 +1683,7 @@ def save_dataframe_with_formatting(forecast_df, reference_df, output_path, origi
         logging.info(f"Saving workbook to {output_filepath}")
         workbook.save(output_filepath)
         logging.info(f"Data saved to {output_filepath}")
+        return output_filepath
 
     except Exception as e:
         logging.error(f"An error occurred: {e}")
@@ -227,29 +1695,815 @@ def set_forecast_sheet_as_active(workbook):
         workbook.active = workbook.sheetnames.index("Working")
 
 
+def forecast_parameters(args):
+    """Normalizes the forecast parameters of a main() args dict."""
+    return {
+        'references_month': int(args.get('references_month', 6)),
+        'references_year': int(args.get('references_year', 2024)),
+        'target_start_year': int(args.get('target_start_year', 2025)),
+        'target_end_year': int(args.get('target_end_year', 2025)),
+        'specifics_enabled': bool(args.get('specifics_enabled', False)),
+        'prod_nums': args.get('prod_nums') or [],
+        'bus_chanl_nums': args.get('bus_chanl_nums') or [],
+    }
+
+
+def scenario_parameters(args):
+    """The forecast_parameters() of every args['scenarios'] entry, each falling back on args for what it leaves out."""
+    return [forecast_parameters({**args, **scenario}) for scenario in args['scenarios']]
+
+
+def run_scenarios(source, args, output_dir, file_path, groupings=None):
+    """Runs every args['scenarios'] entry against one loaded source, writing forecast_audience_<name>.xlsx each."""
+    scenarios = scenario_parameters(args)
+    results = calculate_forecast_many(source, scenarios)
+    for index, (entry, scenario, (forecast_df, reference_df)) in enumerate(zip(args['scenarios'], scenarios,
+                                                                               results), 1):
+        name = entry.get('name', str(index))
+        if forecast_df.empty:
+            logging.error(f"Scenario {name} produced no forecast.")
+            continue
+        save_dataframe_with_formatting(forecast_df, reference_df, output_dir, workbook_template(file_path),
+                                       scenario['references_year'], scenario['prod_nums'], scenario['bus_chanl_nums'],
+                                       output_filename=f"forecast_audience_{name}.xlsx",
+                                       summary_sheets=rollup_summary_sheets(forecast_df, groupings,
+                                                                            source.metrics))
+
+
+BACKTEST_METRICS = ['MAPE', 'WAPE', 'BIAS']
+
+
+def backtest_origin(df, cutoff_key, holdout_months, parameters, model='ratio', model_options=None, metrics=None):
+    """Forecasts the holdout_months after cutoff_key from the rows up to it, and pairs the forecast with the hidden
+    actuals on the four key columns. Missing forecasts or actuals count as zero minutes."""
+    source = AudienceSource(df, metrics)
+    history = source.df.iloc[np.sort(source.period_positions(source.sorted_keys[0], cutoff_key))]
+    actual = source.df.iloc[np.sort(source.period_positions(cutoff_key + 1, cutoff_key + holdout_months))]
+    actual = filter_specifics(actual, parameters['specifics_enabled'], parameters['prod_nums'],
+                              parameters['bus_chanl_nums'], source.id_encodings)
+
+    first_year, last_year = (cutoff_key // 12), ((cutoff_key + holdout_months - 1) // 12)
+    origin = {**parameters, 'references_month': (cutoff_key - 1) % 12 + 1,
+              'references_year': (cutoff_key - 1) // 12, 'target_start_year': first_year,
+              'target_end_year': last_year}
+    if model == 'ratio':
+        forecast_df, _ = calculate_forecast_vectorized(AudienceSource(history, source.metrics), **origin)
+    else:
+        forecast_df, _ = calculate_forecast_model(AudienceSource(history, source.metrics), **origin, model=model,
+                                                  **(model_options or {}))
+    if not forecast_df.empty:
+        keys = period_key(forecast_df['PERIOD_YEAR'], forecast_df['PERIOD_MONTH']).to_numpy()
+        forecast_df = forecast_df[(keys > cutoff_key) & (keys <= cutoff_key + holdout_months)]
+    else:
+        forecast_df = pd.DataFrame(columns=actual.columns)
+
+    metrics = source.metrics
+    paired = forecast_df[KEY_COLUMNS + metrics].merge(
+        actual[KEY_COLUMNS + metrics], on=KEY_COLUMNS, how='outer', suffixes=('_FORECAST', '_ACTUAL'))
+    paired.insert(0, 'ORIGIN', f"{origin['references_month']:02d}-{origin['references_year']}")
+    return paired
+
+
+def error_metrics(codes, n_groups, forecast, actual):
+    """MAPE, WAPE and bias of every group at once; forecast and actual are (rows x columns) arrays.
+
+    MAPE averages |error| / |actual| over rows with a non-zero actual. WAPE is sum |error| / sum |actual| and bias
+    sum (forecast - actual) / sum |actual|. Groups without actual minutes get NaN.
+    """
+    def group_sums(values):
+        return np.stack([np.bincount(codes, weights=values[:, col], minlength=n_groups)
+                         for col in range(values.shape[1])], axis=1)
+
+    errors = forecast - actual
+    absolute_actual = np.abs(actual)
+    nonzero = absolute_actual > 0
+    with np.errstate(divide='ignore', invalid='ignore'):
+        percentage_errors = np.where(nonzero, np.abs(errors) / absolute_actual, 0.0)
+        actual_totals = group_sums(absolute_actual)
+        return {
+            'MAPE': group_sums(percentage_errors) / group_sums(nonzero.astype('float64')),
+            'WAPE': group_sums(np.abs(errors)) / actual_totals,
+            'BIAS': group_sums(errors) / actual_totals,
+        }
+
+
+def backtest_metrics(paired, group_columns):
+    """One row per distinct group_columns value with <column>_MAPE/_WAPE/_BIAS for every viewing-minutes column."""
+    codes = paired.groupby(group_columns, sort=False, dropna=False, observed=True).ngroup().to_numpy()
+    groups = paired[group_columns].drop_duplicates()
+    metrics = [col[:-len('_FORECAST')] for col in paired.columns if str(col).endswith('_FORECAST')]
+    forecast = paired[[f"{col}_FORECAST" for col in metrics]].to_numpy(dtype='float64')
+    actual = paired[[f"{col}_ACTUAL" for col in metrics]].to_numpy(dtype='float64')
+    errors = error_metrics(codes, len(groups), np.nan_to_num(forecast), np.nan_to_num(actual))
+
+    result = groups.reset_index(drop=True)
+    for index, col in enumerate(metrics):
+        for name in BACKTEST_METRICS:
+            result[f"{col}_{name}"] = errors[name][:, index]
+    return result
+
+
+def run_backtest(source, parameters, output_dir, holdout_months=12, origins=1, origin_step=1, model='ratio',
+                 model_options=None, groupings=None, workers=None, output_filename="backtest_audience.xlsx"):
+    """Backtests the forecast on the last months of the file and writes the error metrics to backtest_audience.xlsx.
+
+    The latest origin hides the final holdout_months of data; each further origin moves the cutoff origin_step
+    months earlier. Origins run in a process pool. Metrics are reported per origin overall, per series and per
+    group level of the grouping files.
+    """
+    source = as_audience_source(source)
+    last_key = int(source.sorted_keys[-1])
+    cutoffs = [last_key - holdout_months - index * origin_step for index in range(origins)]
+    print(f"Backtesting {len(cutoffs)} origin(s) over {holdout_months} held-out months...")
+
+    jobs = [(source.df, cutoff, holdout_months, parameters, model, model_options, source.metrics)
+            for cutoff in cutoffs]
+    if len(jobs) > 1 and workers != 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            paired = list(executor.map(backtest_origin, *zip(*jobs)))
+    else:
+        paired = [backtest_origin(*job) for job in jobs]
+    paired = pd.concat(paired, ignore_index=True)
+    if paired.empty:
+        logging.error("The backtest produced no forecast or actual rows.")
+        return
+
+    sheets = {'Origin Metrics': backtest_metrics(paired, ['ORIGIN']),
+              'Series Metrics': backtest_metrics(paired, ['ORIGIN'] + ID_COLUMNS)}
+    for level, labels in (groupings or {}).items():
+        paired[level] = group_labels(paired[GROUPINGS[level]['column']], labels)
+        sheets[f"{GROUPINGS[level]['title']} Metrics"] = backtest_metrics(paired, ['ORIGIN', level])
+    return save_sheets(sheets, output_dir, output_filename)
+
+
+def save_sheets(sheets, output_path, output_filename):
+    """Writes {title: frame} to a new, styled workbook."""
+    output_filepath = output_file(output_path, output_filename)
+    if output_filepath is None:
+        return
+
+    workbook = Workbook()
+    workbook.remove(workbook.active)
+    for title, df in sheets.items():
+        ws = workbook.create_sheet(title=title)
+        write_frame(ws, df)
+        style_worksheet(ws)
+    workbook.save(output_filepath)
+    logging.info(f"Data saved to {output_filepath}")
+    return output_filepath
+
+
+class ForecastSession:
+    """Keeps one audience file in memory for quick what-if forecasts.
+
+    Reference windows, their growth factors and minutes blocks are prepared once per (reference month, reference
+    year, target years) and reused by later previews. A preview applies the overrides (specifics, per-product
+    growth multipliers, excluded channels) to those cached arrays and returns yearly totals without building any
+    forecast rows. confirm() writes the formatted workbook of the last preview.
+    """
+
+    def __init__(self, file_path, data=None, groupings=None, source_cache_dir=None, metrics=None):
+        self.file_path = file_path
+        self.source = AudienceSource(apply_audience_schema(
+            load_audience(file_path, cache_dir=source_cache_dir) if data is None else data), metrics)
+        self.groupings = groupings or {}
+        self.prepared = {}
+        self.last_request = None
+
+    def prepare(self, references_month, references_year, target_start_year, target_end_year):
+        key = (references_month, references_year, target_start_year, target_end_year)
+        if key not in self.prepared:
+            window = self.source.reference_window(references_month, references_year)
+            metrics = self.source.metrics
+            self.prepared[key] = {
+                'window': window,
+                'metrics': metrics,
+                'block': np.nan_to_num(window[metrics].to_numpy(dtype='float64')),
+                'factors': align_growth_factors(compute_growth_factors(window, target_start_year, target_end_year),
+                                                window),
+                'has_duplicates': bool(window.duplicated(subset=KEY_COLUMNS).any()),
+            }
+        return self.prepared[key]
+
+    def selection(self, prepared, specifics_enabled, prod_nums, bus_chanl_nums, product_multipliers=None,
+                  excluded_channels=None):
+        """Rows of the prepared window to forecast and their growth factors after the overrides."""
+        window = prepared['window']
+        encodings = self.source.id_encodings
+        keep = np.ones(len(window), dtype=bool)
+        if specifics_enabled:
+            keep &= specifics_mask(window, prod_nums, bus_chanl_nums, encodings)
+        if excluded_channels:
+            keep &= ~encodings['BUS_CHANL_NUM'].mask(window['BUS_CHANL_NUM'], excluded_channels)
+
+        factors = prepared['factors'][keep]
+        if product_multipliers:
+            encoding = encodings['PROD_NUM']
+            table = np.ones(len(encoding.labels) + 1)
+            for prod_num, multiplier in product_multipliers.items():
+                table[:-1][encoding.labels == str(prod_num)] = float(multiplier)
+            weights = table[encoding.codes(window['PROD_NUM'])[keep]][:, None]
+            # Unscaled rows take the multiplier alone; rows without one stay NaN, i.e. carried over as is.
+            factors = np.where(np.isnan(factors), np.where(weights != 1.0, weights, np.nan), factors * weights)
+        return keep, factors
+
+    def preview(self, references_month, references_year, target_start_year, target_end_year, specifics_enabled=False,
+                prod_nums=None, bus_chanl_nums=None, product_multipliers=None, excluded_channels=None):
+        """Yearly forecast totals of every metric column and the forecast row count, or None on duplicate keys."""
+        request = dict(references_month=references_month, references_year=references_year,
+                       target_start_year=target_start_year, target_end_year=target_end_year,
+                       specifics_enabled=specifics_enabled, prod_nums=prod_nums or [],
+                       bus_chanl_nums=bus_chanl_nums or [], product_multipliers=product_multipliers or {},
+                       excluded_channels=excluded_channels or [])
+        prepared = self.prepare(references_month, references_year, target_start_year, target_end_year)
+        keep, factors = self.selection(prepared, specifics_enabled, request['prod_nums'], request['bus_chanl_nums'],
+                                       request['product_multipliers'], request['excluded_channels'])
+        if prepared['has_duplicates'] and has_duplicate_keys(prepared['window'][keep]):
+            return None
+
+        self.last_request = request
+        totals = np.where(np.isnan(factors), 1.0, factors).T @ prepared['block'][keep]
+        preview = pd.DataFrame(totals, columns=prepared['metrics'],
+                               index=pd.Index(range(target_start_year, target_end_year + 1), name='PERIOD_YEAR'))
+        preview['ROWS'] = int(keep.sum())
+        return preview
+
+    def confirm(self, output_dir, output_filename="forecast_audience.xlsx", diff=False, state_dir=None):
+        """Builds the forecast of the last preview and writes it like a regular run; returns the workbook path.
+
+        The written forecast becomes the snapshot later runs of the same parameters are compared with; diff adds
+        the Changes sheet against the previous one, as in main().
+        """
+        if self.last_request is None:
+            logging.error("Nothing to write: run a preview first.")
+            return
+        request = self.last_request
+        prepared = self.prepare(request['references_month'], request['references_year'],
+                                request['target_start_year'], request['target_end_year'])
+        keep, factors = self.selection(prepared, request['specifics_enabled'], request['prod_nums'],
+                                       request['bus_chanl_nums'], request['product_multipliers'],
+                                       request['excluded_channels'])
+        reference_data = prepared['window'][keep]
+        forecast_df = forecast_reference_rows(reference_data, factors, request['target_start_year'],
+                                              request['target_end_year'],
+                                              metrics=prepared['metrics']).reset_index(drop=True)
+        parameters = forecast_parameters(request)
+        state_dir = state_dir or os.path.join(output_dir, '.forecast_state')
+        snapshot = forecast_snapshot(forecast_df, prepared['metrics'])
+        summary_sheets = changes_summary_sheets(snapshot, state_dir, parameters) if diff else {}
+        summary_sheets.update(rollup_summary_sheets(forecast_df, self.groupings, prepared['metrics']))
+        output_filepath = save_dataframe_with_formatting(forecast_df, reference_data, output_dir,
+                                                         workbook_template(self.file_path),
+                                                         request['references_year'], request['prod_nums'],
+                                                         request['bus_chanl_nums'], output_filename=output_filename,
+                                                         summary_sheets=summary_sheets)
+        if output_filepath:
+            store_forecast_snapshot(snapshot, state_dir, parameters)
+        return output_filepath
+
+
+EXCEL_MAX_ROWS = 1048576
+SNAPSHOT_BASENAME = "previous_forecast"
+
+
+def id_strings(column):
+    """String form of an ID column; categorical columns convert each category once."""
+    if isinstance(column.dtype, pd.CategoricalDtype):
+        labels = np.append(column.cat.categories.astype(str).to_numpy(dtype=object), None)
+        return labels[column.cat.codes.to_numpy()]
+    return column.astype(str).to_numpy(dtype=object)
+
+
+def forecast_snapshot(forecast_df, metrics=None):
+    """The key and metric columns of a forecast, with int64 periods and string IDs so runs join reliably."""
+    snapshot = pd.DataFrame({
+        'PERIOD_YEAR': forecast_df['PERIOD_YEAR'].to_numpy(dtype='int64'),
+        'PERIOD_MONTH': forecast_df['PERIOD_MONTH'].to_numpy(dtype='int64'),
+        'PROD_NUM': id_strings(forecast_df['PROD_NUM']),
+        'BUS_CHANL_NUM': id_strings(forecast_df['BUS_CHANL_NUM']),
+    })
+    for col in metric_columns(forecast_df.columns, metrics):
+        snapshot[col] = forecast_df[col].to_numpy(dtype='float64')
+    return snapshot
+
+
+def columnar_path(directory, basename):
+    """Parquet when pyarrow or fastparquet is installed, a pickle otherwise."""
+    parquet = any(importlib.util.find_spec(engine) for engine in ('pyarrow', 'fastparquet'))
+    return os.path.join(directory, basename + ('.parquet' if parquet else '.pkl'))
+
+
+def read_columnar(path):
+    return pd.read_parquet(path) if path.endswith('.parquet') else pd.read_pickle(path)
+
+
+def write_columnar(df, path):
+    """Writes df to path, falling back to a pickle next to it when parquet cannot hold a column (mixed types)."""
+    if path.endswith('.parquet'):
+        try:
+            df.to_parquet(path, index=False)
+            return path
+        except Exception as e:
+            logging.warning(f"Could not write {path}, using a pickle instead: {e}")
+            path = path[:-len('.parquet')] + '.pkl'
+    df.to_pickle(path)
+    return path
+
+
+def snapshot_path(state_dir, parameters):
+    """One snapshot per parameter set, so a run is only compared with a previous run of the same forecast."""
+    return columnar_path(state_dir, f"{SNAPSHOT_BASENAME}_{parameters_digest(parameters)}")
+
+
+def load_forecast_snapshot(state_dir, parameters):
+    path = snapshot_path(state_dir, parameters)
+    # write_columnar falls back to a pickle next to the parquet path.
+    for candidate in dict.fromkeys((path, os.path.splitext(path)[0] + '.pkl')):
+        if os.path.exists(candidate):
+            try:
+                return read_columnar(candidate)
+            except Exception as e:
+                logging.warning(f"Could not read the previous forecast {candidate}: {e}")
+                return None
+    return None
+
+
+def store_forecast_snapshot(snapshot, state_dir, parameters):
+    os.makedirs(state_dir, exist_ok=True)
+    path = snapshot_path(state_dir, parameters)
+    # A pickle fallback must not leave an older parquet snapshot to be read instead.
+    if write_columnar(snapshot, path) != path and os.path.exists(path):
+        os.remove(path)
+
+
+def changes_summary_sheets(snapshot, state_dir, parameters):
+    """{'Changes': rows} of snapshot against the stored snapshot of the same parameters; empty without one."""
+    previous = load_forecast_snapshot(state_dir, parameters)
+    if previous is None:
+        return {}
+    changes = forecast_changes(previous, snapshot)
+    logging.info(f"{len(changes)} forecast rows changed since the previous run")
+    if len(changes) >= EXCEL_MAX_ROWS:
+        logging.warning(f"Only the first {EXCEL_MAX_ROWS - 1} changed rows fit in the Changes sheet")
+    return {'Changes': changes.iloc[:EXCEL_MAX_ROWS - 1]}
+
+
+def forecast_changes(previous, current, tolerance=1e-9):
+    """Rows whose minutes differ between two forecast snapshots, from one keyed outer join.
+
+    The four key columns are packed into a single int64 join key, and rows come out sorted on it. STATUS is
+    'added', 'removed' or 'changed'. For every metric column the previous and current values come with their
+    absolute delta and the delta as a percentage of the previous value (NaN when that is zero or missing).
+    """
+    metrics = [col for col in current.columns if col not in KEY_COLUMNS and col in previous.columns]
+    frames = (previous, current)
+    prod_codes, prod_nums = pd.factorize(np.concatenate([frame['PROD_NUM'].to_numpy(dtype=object) for frame in frames]))
+    chanl_codes, chanl_nums = pd.factorize(np.concatenate([frame['BUS_CHANL_NUM'].to_numpy(dtype=object)
+                                                           for frame in frames]))
+    periods = np.concatenate([period_key(frame['PERIOD_YEAR'].to_numpy(dtype='int64'),
+                                         frame['PERIOD_MONTH'].to_numpy(dtype='int64')) for frame in frames])
+    keys = (periods * (len(prod_nums) + 1) + prod_codes + 1) * (len(chanl_nums) + 1) + chanl_codes + 1
+    merged = pd.DataFrame(previous[metrics].to_numpy(dtype='float64'), columns=metrics).assign(
+        _KEY=keys[:len(previous)]).merge(
+        pd.DataFrame(current[metrics].to_numpy(dtype='float64'), columns=metrics).assign(_KEY=keys[len(previous):]),
+        on='_KEY', how='outer', sort=True, suffixes=('_PREVIOUS', '_CURRENT'), indicator=True)
+
+    before = merged[[f"{col}_PREVIOUS" for col in metrics]].to_numpy(dtype='float64')
+    after = merged[[f"{col}_CURRENT" for col in metrics]].to_numpy(dtype='float64')
+    delta = np.nan_to_num(after) - np.nan_to_num(before)
+    scale = np.maximum(np.abs(np.nan_to_num(before)), 1.0)
+    sides = merged['_merge'].to_numpy(dtype=object)
+    changed = (sides != 'both') | (np.abs(delta) > tolerance * scale).any(axis=1) | \
+        (np.isnan(before) != np.isnan(after)).any(axis=1)
+
+    keys = merged['_KEY'].to_numpy()[changed]
+    chanl_codes = keys % (len(chanl_nums) + 1) - 1
+    prod_codes = keys // (len(chanl_nums) + 1) % (len(prod_nums) + 1) - 1
+    periods = keys // (len(chanl_nums) + 1) // (len(prod_nums) + 1)
+    changes = pd.DataFrame({'PERIOD_YEAR': (periods - 1) // 12, 'PERIOD_MONTH': (periods - 1) % 12 + 1,
+                            'PROD_NUM': np.append(prod_nums, None)[prod_codes],
+                            'BUS_CHANL_NUM': np.append(chanl_nums, None)[chanl_codes]})
+    changes['STATUS'] = np.select([sides[changed] == 'left_only', sides[changed] == 'right_only'],
+                                  ['removed', 'added'], 'changed')
+    with np.errstate(divide='ignore', invalid='ignore'):
+        percentages = np.where(np.nan_to_num(before) != 0, delta / np.abs(before), np.nan) * 100
+    for index, col in enumerate(metrics):
+        changes[f"{col}_PREVIOUS"] = before[changed, index]
+        changes[f"{col}_CURRENT"] = after[changed, index]
+        changes[f"{col}_DELTA"] = delta[changed, index]
+        changes[f"{col}_DELTA_PCT"] = percentages[changed, index]
+    return changes
+
+
+FORECAST_CACHE_MAX_BYTES = 512 * 1024 * 1024
+# Part of every cache key: bump it whenever a change alters forecast results or the workbook layout, so entries
+# written by older code are never restored.
+FORECAST_CACHE_VERSION = 1
+
+
+def file_digest(file_path, chunk_size=1024 * 1024):
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def normalize_parameters(parameters):
+    """Forecast parameters with the ID selections sorted, and dropped when specifics are disabled."""
+    normalized = dict(parameters)
+    if normalized['specifics_enabled']:
+        normalized['prod_nums'] = sorted(str(value) for value in normalized['prod_nums'])
+        normalized['bus_chanl_nums'] = sorted(str(value) for value in normalized['bus_chanl_nums'])
+    else:
+        normalized['prod_nums'] = normalized['bus_chanl_nums'] = []
+    return normalized
+
+
+def parameters_digest(parameters):
+    payload = json.dumps(normalize_parameters(parameters), sort_keys=True)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+def source_digest(path):
+    """Digest of an audience source: its file's digest, or a digest of every extract's in the order they win in."""
+    files = audience_files(path)
+    if len(files) == 1:
+        return file_digest(files[0])
+    return hashlib.sha256(json.dumps([file_digest(file) for file in files]).encode('utf-8')).hexdigest()
+
+
+def forecast_cache_key(file_path, parameters, options=None):
+    """Cache key of a forecast: FORECAST_CACHE_VERSION, the input file contents and the parameters and options that
+    change its result."""
+    payload = json.dumps({'version': FORECAST_CACHE_VERSION, 'file': source_digest(file_path),
+                          'parameters': normalize_parameters(parameters), 'options': options or {}}, sort_keys=True)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class ForecastCache:
+    """On-disk cache of finished forecasts with least-recently-used eviction above max_bytes.
+
+    Each entry is a directory named after its key, holding the forecast and reference frames and, once it has
+    been written, the formatted workbook. Reading an entry refreshes its modification time.
+    """
+
+    def __init__(self, cache_dir, max_bytes=FORECAST_CACHE_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def entry_path(self, key, name=''):
+        return os.path.join(self.cache_dir, key, name)
+
+    def touch(self, key):
+        os.utime(self.entry_path(key))
+
+    def load_frames(self, key):
+        forecast_path = self.entry_path(key, 'forecast.pkl')
+        reference_path = self.entry_path(key, 'reference.pkl')
+        if not (os.path.isfile(forecast_path) and os.path.isfile(reference_path)):
+            return None
+        self.touch(key)
+        return pd.read_pickle(forecast_path), pd.read_pickle(reference_path)
+
+    def store_frames(self, key, forecast_df, reference_df):
+        os.makedirs(self.entry_path(key), exist_ok=True)
+        forecast_df.to_pickle(self.entry_path(key, 'forecast.pkl'))
+        reference_df.to_pickle(self.entry_path(key, 'reference.pkl'))
+        self.evict()
+
+    def restore_workbook(self, key, output_filepath):
+        """Copies the cached workbook to output_filepath; returns False when there is none or the copy failed."""
+        cached_workbook = self.entry_path(key, 'workbook.xlsx')
+        if not os.path.isfile(cached_workbook) or check_file_open(output_filepath):
+            return False
+        shutil.copyfile(cached_workbook, output_filepath)
+        self.touch(key)
+        return True
+
+    def store_workbook(self, key, workbook_path):
+        os.makedirs(self.entry_path(key), exist_ok=True)
+        shutil.copyfile(workbook_path, self.entry_path(key, 'workbook.xlsx'))
+        self.evict()
+
+    def evict(self):
+        evict_least_recently_used(self.cache_dir, self.max_bytes, "forecast cache entry")
+
+
+def run_streaming_forecast(source, parameters, output_dir):
+    """Vectorized forecast written block by block to forecast_audience.xlsx instead of being built in memory."""
+    source = as_audience_source(source)
+    reference_data = select_reference_data(source, parameters['references_month'], parameters['references_year'],
+                                           parameters['specifics_enabled'], parameters['prod_nums'],
+                                           parameters['bus_chanl_nums'])
+    if reference_data is None or reference_data.empty:
+        return
+
+    print("Calculating reference growth factors...")
+    factors = align_growth_factors(compute_growth_factors(reference_data, parameters['target_start_year'],
+                                                          parameters['target_end_year']), reference_data)
+    blocks = iter_forecast_blocks(reference_data, factors, parameters['target_start_year'],
+                                  parameters['target_end_year'], source.metrics)
+    return save_forecast_stream(blocks, reference_data, output_dir)
+
+
+CSV_CHUNK_ROWS = 1_000_000
+
+
+def read_reference_window_csv(file_path, references_month, references_year, chunksize=CSV_CHUNK_ROWS):
+    """Streams a CSV audience export chunk by chunk and keeps only the 12-month reference window.
+
+    Returns the window, ordered like AudienceSource.reference_window, and its eop_volume_sums, accumulated one
+    chunk at a time. Only the window and one chunk are in memory at once.
+    """
+    reference_key = period_key(references_year, references_month)
+    kept = []
+    volumes = []
+    rows = 0
+    for chunk in pd.read_csv(file_path, chunksize=chunksize, dtype={col: 'object' for col in ID_COLUMNS}):
+        rows += len(chunk)
+        keys = period_key(chunk['PERIOD_YEAR'].to_numpy(dtype='int64'), chunk['PERIOD_MONTH'].to_numpy(dtype='int64'))
+        chunk = chunk[(keys >= reference_key - 11) & (keys <= reference_key)]
+        if not chunk.empty:
+            kept.append(chunk)
+            volumes.append(eop_volume_sums(chunk))
+        print(f"Read {rows} rows, {sum(len(part) for part in kept)} in the reference window")
+
+    if not kept:
+        return pd.DataFrame(), None
+    window = pd.concat(kept)
+    window = window.iloc[np.argsort(window['PERIOD_YEAR'].to_numpy(), kind='stable')]
+    volumes = pd.concat(volumes)
+    return window, volumes.groupby(level=list(range(volumes.index.nlevels))).sum()
+
+
+def save_forecast_csv(forecast_blocks, reference_df, output_path, output_filename="forecast_audience.csv"):
+    """Appends forecast blocks to a CSV file, with the reference window next to it in *_reference.csv."""
+    output_filepath = output_file(output_path, output_filename)
+    reference_filepath = output_file(output_path, os.path.splitext(output_filename)[0] + "_reference.csv")
+    if output_filepath is None or reference_filepath is None:
+        return
+
+    try:
+        rows = 0
+        logging.info(f"Streaming forecast blocks to {output_filepath}")
+        for block in forecast_blocks:
+            block.to_csv(output_filepath, mode='w' if rows == 0 else 'a', header=rows == 0, index=False)
+            rows += len(block)
+        reference_df.to_csv(reference_filepath, index=False)
+        logging.info(f"Data saved to {output_filepath} ({rows} forecast rows)")
+        return output_filepath
+    except Exception as e:
+        logging.error(f"Failed to save data: {e}")
+        raise
+
+
+def run_chunked_forecast(file_path, parameters, output_dir, duplicates_policy='error', float32_minutes=False,
+                         chunksize=CSV_CHUNK_ROWS, metrics=None):
+    """Vectorized ratio forecast of a CSV export too large to load whole: peak memory follows the reference window.
+
+    main() only takes this path when args['chunked'] is set; other CSV sources are loaded whole like Excel ones.
+    """
+    print("Reading the reference window in chunks...")
+    window, volumes = read_reference_window_csv(file_path, parameters['references_month'],
+                                                parameters['references_year'], chunksize)
+    if window.empty:
+        logging.error("No rows in the reference window.")
+        return
+
+    reference_data = filter_specifics(apply_audience_schema(window, float32_minutes, metrics),
+                                      parameters['specifics_enabled'],
+                                      parameters['prod_nums'], parameters['bus_chanl_nums'])
+    resolved = resolve_duplicate_keys(reference_data, reference_data, output_dir, duplicates_policy, metrics)
+    if resolved is None:
+        return
+    if resolved is not reference_data:
+        reference_data = resolved
+        volumes = eop_volume_sums(reference_data)
+    if reference_data.empty:
+        logging.error("No reference rows left after the specifics filter.")
+        return
+
+    print("Calculating reference growth factors...")
+    growth_factors = growth_factors_from_volumes(volumes, parameters['target_start_year'],
+                                                 parameters['target_end_year'])
+    factors = align_growth_factors(growth_factors, reference_data)
+    blocks = iter_forecast_blocks(reference_data, factors, parameters['target_start_year'],
+                                  parameters['target_end_year'], metrics)
+    return save_forecast_csv(blocks, reference_data, output_dir)
+
+
+# Options of a main() args dict that a reduced run mode cannot honour, with the value it runs with anyway.
+CHUNKED_IGNORED_OPTIONS = {'engine': 'vectorized', 'model': 'ratio', 'intervals': None, 'inactive_series': None,
+                           'gap_fill': None, 'diff': None, 'reconciliation': None, 'channel_grouping_src': None,
+                           'product_grouping_src': None, 'cache': None, 'cache_dir': None, 'source_cache_dir': None,
+                           'scenarios': None, 'streaming': None, 'backtest': None}
+STREAMING_IGNORED_OPTIONS = {'engine': 'vectorized', 'model': 'ratio', 'intervals': None, 'inactive_series': None,
+                             'diff': None, 'reconciliation': None, 'channel_grouping_src': None,
+                             'product_grouping_src': None, 'cache_dir': None}
+BACKTEST_IGNORED_OPTIONS = {'engine': 'vectorized', 'intervals': None, 'inactive_series': None, 'diff': None,
+                            'reconciliation': None, 'cache_dir': None, 'scenarios': None, 'streaming': None}
+SCENARIO_IGNORED_OPTIONS = {'engine': 'vectorized', 'model': 'ratio', 'intervals': None, 'inactive_series': None,
+                            'diff': None, 'reconciliation': None, 'cache_dir': None, 'streaming': None}
+
+
+def warn_ignored_options(args, ignored_options, mode):
+    """Logs a warning for every option of args that mode ignores, i.e. set to anything but its supported value."""
+    for option, supported in ignored_options.items():
+        value = args.get(option)
+        if value not in (None, False, '', [], {}) and value != supported:
+            logging.warning(f"{option}={value!r} is not supported by {mode} and is ignored.")
+
+
 def main(args):
     file_path = args.get('file_path')
-    if not file_path or not os.path.exists(file_path):
+    if not file_path or (isinstance(file_path, str) and not os.path.exists(file_path)):
         logging.error(f"The specified file does not exist: {file_path}")
         return
+    files = audience_files(file_path)
+    missing_files = [path for path in files if not os.path.isfile(path)]
+    if not files or missing_files:
+        logging.error(f"No audience extracts to read in {file_path}" if not files else
+                      f"The specified files do not exist: {missing_files}")
+        return
 
-    references_month = int(args.get('references_month', 6))
-    references_year = int(args.get('references_year', 2024))
-    target_start_year = int(args.get('target_start_year', 2025))
-    target_end_year = int(args.get('target_end_year', 2025))
-    specifics_enabled = args.get('specifics_enabled', False)
-    prod_nums = args.get('prod_nums', [])
-    bus_chanl_nums = args.get('bus_chanl_nums', [])
+    parameters = forecast_parameters(args)
+    engine = args.get('engine', 'vectorized')
+    engine_options = {}
+    if engine == 'parallel':
+        engine_options['workers'] = args.get('workers')
+        engine_options['partition_column'] = args.get('partition_column', 'PROD_NUM')
     output_dir = args.get('output_dir')
     if not output_dir or not os.path.exists(output_dir):
         logging.error(f"The specified output directory does not exist: {output_dir}")
         return
+    remove_run_reports(output_dir)
+    state_dir = args.get('state_dir') or os.path.join(output_dir, '.forecast_state')
+    if engine == 'incremental':
+        engine_options['state_dir'] = state_dir
+
+    if engine not in FORECAST_ENGINES:
+        logging.error(f"Unknown forecast engine: {engine}")
+        return
+    if engine_options.get('partition_column', 'PROD_NUM') not in ('PROD_NUM', 'BUS_CHANL_NUM'):
+        logging.error(f"Unsupported partition column: {engine_options['partition_column']}")
+        return
 
-    df = load_excel(file_path)
+    model = args.get('model', 'ratio')
+    forecast_function = FORECAST_ENGINES[engine]
+    if model != 'ratio':
+        if model not in FORECAST_MODELS:
+            logging.error(f"Unknown forecast model: {model}")
+            return
+        forecast_function = calculate_forecast_model
+        engine_options = {'model': model}
+        if model == 'holt_winters':
+            errors = smoothing_errors(args.get('smoothing'), args.get('smoothing_grid'))
+            if errors:
+                logging.error(f"Invalid Holt-Winters smoothing: {'; '.join(errors)}")
+                return
+            engine_options['smoothing'] = args.get('smoothing')
+            engine_options['smoothing_grid'] = args.get('smoothing_grid')
+
+    model_options = {key: value for key, value in engine_options.items() if key != 'model'} \
+        if model != 'ratio' else None
+    cache_options = dict(engine_options) if model != 'ratio' else {'model': model}
+    interval_options = None
+    if args.get('intervals'):
+        interval_options = {'samples': int(args.get('bootstrap_samples', 200)), 'seed': args.get('seed', 0),
+                            'model': model}
+        if model_options is not None:
+            interval_options['model_options'] = model_options
+        cache_options['intervals'] = interval_options
+
+    duplicates_policy = args.get('duplicates_policy', 'error')
+    if duplicates_policy not in DUPLICATE_POLICIES:
+        logging.error(f"Unknown duplicates policy: {duplicates_policy}")
+        return
+    if duplicates_policy != 'error':
+        cache_options['duplicates_policy'] = duplicates_policy
+    metrics = list(args.get('metric_columns') or []) or None
+    if metrics:
+        cache_options['metric_columns'] = metrics
+    float32_minutes = bool(args.get('float32_minutes', False))
+    if float32_minutes:
+        cache_options['float32_minutes'] = True
+    gap_fill = args.get('gap_fill')
+    if gap_fill is not None and gap_fill not in GAP_FILL_STRATEGIES:
+        logging.error(f"Unknown gap fill strategy: {gap_fill}")
+        return
+    if gap_fill:
+        cache_options['gap_fill'] = gap_fill
+    source_cache_dir = None
+    if args.get('cache', True):
+        source_cache_dir = args.get('source_cache_dir') or os.path.join(output_dir, '.source_cache')
+
+    grouping_sources = {'channel_grouping_src': args.get('channel_grouping_src'),
+                        'product_grouping_src': args.get('product_grouping_src')}
+    grouping_sources = {key: src for key, src in grouping_sources.items() if src and os.path.exists(src)}
+    groupings = load_groupings(**grouping_sources)
+    if groupings:
+        cache_options['groupings'] = {key: file_digest(src) for key, src in grouping_sources.items()}
+    reconciliation = args.get('reconciliation')
+    reconciliation_level = args.get('reconciliation_level', TOTAL_LEVEL)
+    if reconciliation:
+        if reconciliation not in RECONCILIATION_METHODS:
+            logging.error(f"Unknown reconciliation method: {reconciliation}. Bottom-up group totals are the group "
+                          f"rollup sheets of a regular run.")
+            return
+        if reconciliation_level != TOTAL_LEVEL and reconciliation_level not in groupings:
+            logging.error(f"Reconciliation level {reconciliation_level} needs its grouping file")
+            return
+        cache_options['reconciliation'] = [reconciliation, reconciliation_level]
+
+    if args.get('chunked'):
+        if not (isinstance(file_path, str) and file_path.lower().endswith('.csv')):
+            logging.error(f"Chunked forecasts read a single CSV export, not {file_path}")
+            return
+        warn_ignored_options(args, CHUNKED_IGNORED_OPTIONS, "chunked CSV forecasts")
+        run_chunked_forecast(file_path, parameters, output_dir, duplicates_policy, float32_minutes,
+                             int(args.get('chunksize', CSV_CHUNK_ROWS)), metrics)
+        return
+
+    if args.get('scenarios') or args.get('streaming') or args.get('backtest'):
+        checked_parameters = scenario_parameters(args) if args.get('scenarios') and not args.get('backtest') \
+            else parameters
+        source = prepare_source(file_path, checked_parameters, output_dir, duplicates_policy, float32_minutes,
+                                source_cache_dir, gap_fill, metrics)
+        if source is None:
+            return
+        if args.get('backtest'):
+            warn_ignored_options(args, BACKTEST_IGNORED_OPTIONS, "backtests")
+            run_backtest(source, parameters, output_dir, int(args.get('holdout_months', 12)),
+                         int(args.get('backtest_origins', 1)), int(args.get('origin_step', 1)), model,
+                         model_options, groupings, args.get('workers'))
+        elif args.get('scenarios'):
+            warn_ignored_options(args, SCENARIO_IGNORED_OPTIONS, "scenario forecasts")
+            run_scenarios(source, args, output_dir, file_path, groupings)
+        else:
+            warn_ignored_options(args, STREAMING_IGNORED_OPTIONS, "streaming forecasts")
+            run_streaming_forecast(source, parameters, output_dir)
+        return
+
+    inactive_series = args.get('inactive_series')
+    if inactive_series:
+        if inactive_series not in INACTIVE_SERIES_POLICIES:
+            logging.error(f"Unknown inactive series policy: {inactive_series}")
+            return
+        engine_options = {'forecast_function': forecast_function, 'inactive_series': inactive_series,
+                          **engine_options}
+        forecast_function = calculate_forecast_active
+        cache_options['inactive_series'] = inactive_series
+
+    cache = cache_key = None
+    if args.get('cache', True):
+        cache = ForecastCache(args.get('cache_dir') or os.path.join(output_dir, '.forecast_cache'),
+                              int(args.get('cache_max_bytes', FORECAST_CACHE_MAX_BYTES)))
+        cache_key = forecast_cache_key(file_path, parameters, cache_options)
+        if not args.get('diff') and cache.restore_workbook(cache_key,
+                                                           os.path.join(output_dir, "forecast_audience.xlsx")):
+            logging.info("Forecast workbook restored from cache")
+            cached_frames = cache.load_frames(cache_key)
+            if cached_frames is not None:
+                store_forecast_snapshot(forecast_snapshot(cached_frames[0], metrics), state_dir, parameters)
+            return
+
+    cached_frames = cache.load_frames(cache_key) if cache else None
+    if cached_frames is not None:
+        logging.info("Forecast loaded from cache")
+        forecast_df, reference_df = cached_frames
+    else:
+        source = prepare_source(file_path, parameters, output_dir, duplicates_policy, float32_minutes,
+                                source_cache_dir, gap_fill, metrics)
+        if source is None:
+            return
+        forecast_df, reference_df = forecast_function(source, **parameters, **engine_options)
+        if reconciliation and not forecast_df.empty:
+            print(f"Reconciling the forecast top-down from {reconciliation_level}...")
+            forecast_df = reconcile_top_down(forecast_df, reference_df, groupings, reconciliation_level, metrics,
+                                             source, model, model_options)
+        if interval_options and not forecast_df.empty:
+            print("Bootstrapping prediction intervals...")
+            forecast_df = add_prediction_intervals(forecast_df, source, reference_df, parameters['references_month'],
+                                                   parameters['references_year'], **interval_options)
+        if cache and not forecast_df.empty:
+            cache.store_frames(cache_key, forecast_df, reference_df)
 
-    forecast_df, reference_df = calculate_forecast(df, references_month, references_year, target_start_year, target_end_year, specifics_enabled, prod_nums, bus_chanl_nums)
     if not forecast_df.empty:
-        save_dataframe_with_formatting(forecast_df, reference_df, output_dir, file_path, references_year, prod_nums, bus_chanl_nums)
+        # Every written forecast becomes the snapshot the next diff run is compared with.
+        snapshot = forecast_snapshot(forecast_df, metrics)
+        summary_sheets = changes_summary_sheets(snapshot, state_dir, parameters) if args.get('diff') else {}
+        summary_sheets.update(rollup_summary_sheets(forecast_df, groupings, metrics))
+
+        output_filepath = save_dataframe_with_formatting(forecast_df, reference_df, output_dir,
+                                                         workbook_template(file_path),
+                                                         parameters['references_year'], parameters['prod_nums'],
+                                                         parameters['bus_chanl_nums'], summary_sheets=summary_sheets)
+        if output_filepath:
+            store_forecast_snapshot(snapshot, state_dir, parameters)
+            if cache and not args.get('diff'):
+                cache.store_workbook(cache_key, output_filepath)
 
 if __name__ == "__main__":
     if len(sys.argv) > 1:
@@ -10,6 +10,7 @@ from tkinter import ttk
 
 import pandas as pd
 
+from parser.parser_audience import ForecastSession, apply_audience_schema, id_encodings, load_audience, load_groupings
 from utilities import utils
 from utilities.utils import show_message
 
@@ -25,6 +26,8 @@ class AudienceTab(ttk.Frame):
         self.output_dir = None
         self.tooltip = None
         self.df = None
+        self.id_encodings = None
+        self.forecast_session = None
         self.config_ui_callback = config_ui_callback
         self.config_manager = config_manager
         self.config_data = config_manager.get_config()
@@ -240,14 +243,15 @@ class AudienceTab(ttk.Frame):
             # Only clear listbox if not initialized
             if not hasattr(self, 'prod_num_map') or self.prod_num_map is None:
                 self.prod_num_listbox.delete(0, 'end')
-                unique_prod_num = sorted(set(str(item) for item in self.df['PROD_NUM'].unique()))
+                unique_prod_num = sorted(set(self.id_encodings['PROD_NUM'].present_labels(self.df['PROD_NUM'])))
                 for value in unique_prod_num:
                     self.prod_num_listbox.insert('end', value)
                 self.prod_num_map = {str(value): str(value) for value in unique_prod_num}
 
             if not hasattr(self, 'bus_chanl_num_map') or self.bus_chanl_num_map is None:
                 self.bus_chanl_num_listbox.delete(0, 'end')
-                unique_bus_chanl_num = sorted(set(str(item) for item in self.df['BUS_CHANL_NUM'].unique()))
+                unique_bus_chanl_num = sorted(
+                    set(self.id_encodings['BUS_CHANL_NUM'].present_labels(self.df['BUS_CHANL_NUM'])))
                 for value in unique_bus_chanl_num:
                     self.bus_chanl_num_listbox.insert('end', value)
                 self.bus_chanl_num_map = {str(value): str(value) for value in unique_bus_chanl_num}
@@ -376,9 +380,8 @@ class AudienceTab(ttk.Frame):
 
         # select matching
         if selected_bus_chanl_nums:
-            related_prod_nums = set(
-                self.df[self.df['BUS_CHANL_NUM'].astype(str).isin(selected_bus_chanl_nums)]['PROD_NUM'].dropna().astype(
-                    str))
+            channel_rows = self.id_encodings['BUS_CHANL_NUM'].mask(self.df['BUS_CHANL_NUM'], selected_bus_chanl_nums)
+            related_prod_nums = set(self.id_encodings['PROD_NUM'].present_labels(self.df['PROD_NUM'][channel_rows]))
 
             # Mapping to LOOKUP_KEY values
             if hasattr(self, 'lookup_key_to_prod_num') and self.lookup_key_to_prod_num:
@@ -403,12 +406,10 @@ class AudienceTab(ttk.Frame):
         # Mapping LOOKUP_KEYto the original PROD_NUM
         selected_prod_nums_mapped = [self.prod_num_map.get(lookup_key, lookup_key) for lookup_key in selected_prod_nums]
 
-        filtered_df = self.df[
-            (self.df['PROD_NUM'].astype(str).isin(selected_prod_nums_mapped)) &
-            (self.df['BUS_CHANL_NUM'].astype(str).isin(selected_bus_chanl_nums))
-            ]
+        selected_rows = (self.id_encodings['PROD_NUM'].mask(self.df['PROD_NUM'], selected_prod_nums_mapped) &
+                         self.id_encodings['BUS_CHANL_NUM'].mask(self.df['BUS_CHANL_NUM'], selected_bus_chanl_nums))
 
-        self.row_count_label.config(text=f"Selected Rows: {len(filtered_df)}")
+        self.row_count_label.config(text=f"Selected Rows: {int(selected_rows.sum())}")
         self.prod_count_label.config(text=f"Selected Products: {len(set(selected_prod_nums))}")
 
         self.section_specifics_listbox_highlight_top(self.bus_chanl_num_listbox)
@@ -517,11 +518,11 @@ class AudienceTab(ttk.Frame):
         """Toggles the visibility and content of the specifics listboxes based on the checkbox state."""
         if self.specifics_var.get():
             # Check if a file is loaded
-            if not self.file_path or not os.path.isfile(self.file_path):
+            if not self.file_path or self.df is None:
                 # If no file is loaded, prompt the user to load a file
                 self.prompt_excel_load()
                 # Check if a file was successfully loaded after prompting
-                if self.file_path and os.path.isfile(self.file_path):
+                if self.file_path and self.df is not None:
                     self.specifics_var.set(True)  # Set the checkbox to checked
                 else:
                     self.specifics_var.set(False)  # Uncheck the checkbox if no file was loaded
@@ -558,19 +559,7 @@ class AudienceTab(ttk.Frame):
                 return
 
             specifics_enabled = self.specifics_var.get()
-
-            current_selected_bus_chanl_display_values = [self.bus_chanl_num_listbox.get(i) for i in
-                                                         self.bus_chanl_num_listbox.curselection()]
-            if hasattr(self, 'global_selected_channels'):
-                global_selected_bus_chanl_display_values = list(self.global_selected_channels)
-            else:
-                global_selected_bus_chanl_display_values = []
-
-            combined_selected_bus_chanl_display_values = set(
-                current_selected_bus_chanl_display_values + global_selected_bus_chanl_display_values)
-
-            combined_selected_bus_chanl_nums_values = [self.bus_chanl_num_map.get(display_value, display_value) for
-                                                       display_value in combined_selected_bus_chanl_display_values]
+            combined_selected_bus_chanl_nums_values = self.selected_bus_chanl_nums()
 
             print(f"References Month: {references_month}, Year: {references_year}")
             print(f"Target Start Year: {target_start_year}, End Year: {target_end_year}")
@@ -603,6 +592,80 @@ class AudienceTab(ttk.Frame):
             show_message("Error", "Validation failed. Please correct the errors and try again.", type='error',
                          master=self, custom=True)
 
+    def selected_bus_chanl_nums(self):
+        """BUS_CHANL_NUMs of the channels selected in the listbox and kept from previous selections."""
+        current_selected_bus_chanl_display_values = [self.bus_chanl_num_listbox.get(i) for i in
+                                                     self.bus_chanl_num_listbox.curselection()]
+        if hasattr(self, 'global_selected_channels'):
+            global_selected_bus_chanl_display_values = list(self.global_selected_channels)
+        else:
+            global_selected_bus_chanl_display_values = []
+
+        combined_selected_bus_chanl_display_values = set(
+            current_selected_bus_chanl_display_values + global_selected_bus_chanl_display_values)
+
+        return [self.bus_chanl_num_map.get(display_value, display_value) for
+                display_value in combined_selected_bus_chanl_display_values]
+
+    def start_preview(self):
+        """Forecasts the current selection in memory and shows its yearly totals.
+
+        The loaded file stays warm in a ForecastSession between previews; the workbook is only written by
+        write_preview.
+        """
+        if not self.validate_all():
+            show_message("Error", "Validation failed. Please correct the errors and try again.", type='error',
+                         master=self, custom=True)
+            return
+        if self.file_path is None:
+            show_message("Error", "No file selected.", type='error', master=self, custom=True)
+            return
+        if self.output_dir is None:
+            show_message("Error", "No output directory selected.", type='error', master=self, custom=True)
+            return
+
+        try:
+            if self.forecast_session is None or self.forecast_session.file_path != self.file_path:
+                config = self.config_manager.get_config()
+                groupings = load_groupings(config.get('channel_grouping_src'), config.get('product_grouping_src'))
+                self.forecast_session = ForecastSession(self.file_path, data=self.df, groupings=groupings)
+
+            start_time = time.time()
+            preview = self.forecast_session.preview(int(self.references_month.get()),
+                                                    int(self.references_year.get()),
+                                                    int(self.target_start_year.get()),
+                                                    int(self.target_end_year.get()),
+                                                    self.specifics_var.get(), None,
+                                                    self.selected_bus_chanl_nums())
+            duration = time.time() - start_time
+        except Exception as e:
+            print(traceback.format_exc())
+            show_message("Error", f"Preview failed: {e}", type='error', master=self, custom=True)
+            return
+
+        if preview is None:
+            show_message("Error", "Duplicate keys in the reference data, see the console for details.",
+                         type='error', master=self, custom=True)
+            return
+
+        summary = preview.to_string(float_format=lambda value: f"{value:,.0f}")
+        show_message("Forecast Preview",
+                     f"{summary}\n\nComputed in {duration:.2f} seconds.\n\n"
+                     f"Use Write to save it as forecast_audience.xlsx.",
+                     type='info', master=self, custom=True)
+
+    def write_preview(self):
+        """Writes the forecast of the last preview to forecast_audience.xlsx."""
+        if self.forecast_session is None or self.forecast_session.last_request is None:
+            show_message("Error", "Nothing to write: run a preview first.", type='error', master=self, custom=True)
+            return
+        output_filepath = self.forecast_session.confirm(self.output_dir, diff=self.diff_var.get())
+        if output_filepath:
+            show_message("Info", f"Forecast saved to {output_filepath}", type='info', master=self, custom=True)
+        else:
+            show_message("Error", "The forecast could not be saved, see the console for details.",
+                         type='error', master=self, custom=True)
+
     def call_script(self, references_month, references_year, target_start_year, target_end_year,
                     file_path, specifics_enabled, prod_nums, bus_chanl_nums):
 
@@ -623,10 +686,28 @@ class AudienceTab(ttk.Frame):
             "output_dir": output_dir,
             "specifics_enabled": specifics_enabled,
             "prod_nums": prod_nums,
-            "bus_chanl_nums": bus_chanl_nums
+            "bus_chanl_nums": bus_chanl_nums,
+            "channel_grouping_src": self.config_manager.get_config().get('channel_grouping_src'),
+            "product_grouping_src": self.config_manager.get_config().get('product_grouping_src'),
+            "diff": self.diff_var.get()
         }
 
         subprocess.run(["python", script_path, json.dumps(args)])
+        self.show_run_status(output_dir)
+
+    def show_run_status(self, output_dir):
+        """Shows the status left by the parser (e.g. duplicate keys), if any."""
+        status_path = os.path.join(output_dir, "run_status.json")
+        if not os.path.exists(status_path):
+            return
+        try:
+            with open(status_path, 'r') as f:
+                status = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"Could not read the run status: {e}")
+            return
+        message_type = 'error' if status.get('status') == 'duplicates' else 'info'
+        show_message("Forecast", status.get('message', ''), type=message_type, master=self, custom=True)
 
     def sections_reference_target_datefields(self, parent, context):
         if context == 'REFERENCE':
@@ -664,6 +745,8 @@ class AudienceTab(ttk.Frame):
             self.target_end_year.pack(side='left', padx=(2, 10))
             self.target_end_year.insert(0, str(self.current_year + 1))
             ttk.Button(parent, text="✓", command=self.validate_target, style='AudienceTab.TButton').pack(side='right', padx=(0, 10), pady=(0, 0))
+            self.diff_var = BooleanVar()
+            ttk.Checkbutton(parent, text="Changes vs previous run", variable=self.diff_var).pack(side='right', padx=(0, 10))
 
     def tooltip_reference_update(self, event):
         """Dynamically update and show the tooltip based on the current input values."""
@@ -709,6 +792,7 @@ class AudienceTab(ttk.Frame):
     def button_select_sources(self, parent, context):
         if context == 'REFERENCE':
             ttk.Button(parent, text="Source File", command=self.prompt_excel_load, style='AudienceTab.TButton').pack(side='left', padx=10)
+            ttk.Button(parent, text="Source Folder", command=self.prompt_folder_load, style='AudienceTab.TButton').pack(side='left', padx=10)
         if context == 'TARGET':
             ttk.Button(parent, text="Forecast Folder", command=self.section_target_output_location, style='AudienceTab.TButton').pack(side='left', padx=10)
 
@@ -726,25 +810,45 @@ class AudienceTab(ttk.Frame):
         self.file_details_label.pack(side='top', fill='x', expand=False, padx=10, pady=(10, 5))
 
     def prompt_excel_load(self):
+        """Loads one extract, or several monthly extracts merged into one reference set."""
         filetypes = [("Excel files", "*.xlsx *.xls")]
-        filepath = filedialog.askopenfilename(filetypes=filetypes)
-        if filepath:
-            self.section_reference_details_update(filepath)
-            self.df = pd.read_excel(filepath)
+        filepaths = filedialog.askopenfilenames(filetypes=filetypes)
+        if filepaths:
+            # The dialog has no meaningful order: take the files by name, as a folder would be.
+            self.section_reference_details_update(filepaths[0] if len(filepaths) == 1 else sorted(filepaths))
+
+    def prompt_folder_load(self):
+        """Loads every extract of a folder merged into one reference set, later file names winning on shared keys."""
+        folder_selected = filedialog.askdirectory()
+        if folder_selected:
+            self.section_reference_details_update(os.path.normpath(folder_selected))
+
+    def source_cache_dir(self):
+        """Where parsed extracts are kept, shared with the parser runs writing to the same output folder."""
+        return os.path.join(self.output_dir, '.source_cache') if self.output_dir else None
+
+    def set_reference_df(self, df):
+        """Keeps the loaded reference file with its compact schema and its ID encodings for the specifics filters."""
+        self.df = apply_audience_schema(df)
+        self.id_encodings = id_encodings(self.df)
+        self.forecast_session = None
 
     def section_reference_details_update(self, file_path):
         self.file_path = file_path
         try:
-            df = pd.read_excel(file_path)
+            df = load_audience(file_path, cache_dir=self.source_cache_dir())
             self.config_manager.update_config('audience_src', file_path)
             print("File loaded, checking content...")
-            self.df = pd.read_excel(file_path)
+            self.set_reference_df(df)
             if df.empty:
                 print("DataFrame is empty after loading.")
             else:
                 rows, cols = df.shape
-                relative_path = '/'.join(file_path.split('/')[-3:])
-                self.file_details_label.config(text=f".../{relative_path} \t rows: {rows} ~ columns: {cols}")
+                if isinstance(file_path, list):
+                    source_name = f"{len(file_path)} files in .../{'/'.join(file_path[-1].split('/')[-3:-1])}"
+                else:
+                    source_name = '.../' + '/'.join(file_path.split('/')[-3:])
+                self.file_details_label.config(text=f"{source_name} \t rows: {rows} ~ columns: {cols}")
         except PermissionError as e:
             show_message("Error", f"Exception REFERENCE FILE ALREADY OPEN, CLOSE IT:\n {str(e)}", type='error', master=self, custom=True)
         except Exception as e:
@@ -761,10 +865,9 @@ class AudienceTab(ttk.Frame):
 
     def section_reference_button_columns_show(self):
         """Displays the column names from the loaded DataFrame."""
-        if self.file_path:
+        if self.file_path and self.df is not None:
             try:
-                df = pd.read_excel(self.file_path)
-                columns = '\n'.join(df.columns)
+                columns = '\n'.join(self.df.columns)
                 show_message("Columns", f"Columns in the file:\n{columns}", type='info', master=self, custom=True)
             except Exception as e:
                 show_message("Error", f"Failed to load file:\n{str(e)}", type='error', master=self, custom=True)
@@ -825,9 +928,9 @@ class AudienceTab(ttk.Frame):
         return False
 
     def validate_references(self):
-        if self.file_path:
+        if self.file_path and self.df is not None:
             try:
-                df = pd.read_excel(self.file_path)
+                df = self.df
                 month = int(self.references_month.get())
                 year = int(self.references_year.get())
 
@@ -865,8 +968,6 @@ class AudienceTab(ttk.Frame):
                 start_year = int(self.target_start_year.get())
                 end_year = int(self.target_end_year.get())
 
-                df = pd.read_excel(self.file_path)
-
                 current_year = datetime.now().year
 
                 if start_year == current_year:
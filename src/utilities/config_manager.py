@@ -208,7 +208,7 @@ class ConfigLoaderPopup(Toplevel):
         set_window_icon(self)
         self.configure(bg="#f0f0f0")
 
-        files_to_load = {k: v for k, v in self.config_data.items() if os.path.isfile(v)}
+        files_to_load = {k: v for k, v in self.config_data.items() if isinstance(v, str) and os.path.isfile(v)}
 
         data = []
         for key, path in files_to_load.items():